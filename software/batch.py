@@ -0,0 +1,227 @@
+import argparse
+import contextlib
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import cv2 as cv
+import numpy as np
+import main
+from rpm import utils
+
+# --------Batch mode--------
+# Runs main.py's deploy mode for every (video, config) pair of a manifest, one process
+# per core, and summarizes throughput and error. Usage:
+# python batch.py manifest.json [-o runs/batch] [-j workers] [--rerun]
+#
+# The manifest is a JSON list of jobs, paths are relative to the manifest:
+# [{"video": "clips/day1.mp4", "config": "config/turbine1.json"}, ...]
+# A job can also have a "name", by default it's <video>-<config>. Every job writes
+# <name>.csv (the rows), <name>.log (what it printed) and, once it has finished,
+# <name>.json (its results). Jobs with results are skipped, so an interrupted
+# batch picks up where it stopped.
+
+SUMMARY_COLUMNS = [
+    "name",
+    "frames",
+    "seconds",
+    "frames_per_second",
+    "mean_rpm",
+    "real_rpm",
+    "error_percentage",
+    "status",
+]
+
+
+def load_manifest(path: str) -> list[dict]:
+    base = os.path.dirname(os.path.abspath(path))
+    jobs = []
+    for entry in utils.parse_json(path):
+        video = os.path.join(base, entry["video"])
+        config = os.path.join(base, entry["config"])
+        name = entry.get("name") or (
+            f"{os.path.splitext(os.path.basename(video))[0]}-"
+            f"{os.path.splitext(os.path.basename(config))[0]}"
+        )
+        jobs.append({"name": name, "video": video, "config": config})
+
+    names = [job["name"] for job in jobs]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(
+            f"Jobs need unique names, give these a 'name': {', '.join(duplicates)}"
+        )
+    return jobs
+
+
+def result_path(output_dir: str, name: str) -> str:
+    return os.path.join(output_dir, f"{name}.json")
+
+
+def init_worker() -> None:
+    # Every core already has a job, OpenCV's own threads would only compete with them
+    cv.setNumThreads(1)
+
+
+def run_job(job: dict, output_dir: str) -> dict:
+    """
+    Runs one job in deploy mode and saves its results next to its rows.
+
+    Args:
+        job (dict): name, video and config of the job.
+        output_dir (str): where the job's files go.
+
+    Returns:
+        dict: the job's results, see SUMMARY_COLUMNS.
+
+    """
+    params = utils.parse_json(job["config"])
+    if "turbines" in params:
+        raise ValueError("Multi-turbine configs can't be batched, use one per turbine")
+    params["target"] = job["video"]
+
+    name = job["name"]
+    with open(os.path.join(output_dir, f"{name}.log"), "w") as log_file:
+        with contextlib.redirect_stdout(log_file):
+            start = time.perf_counter()
+            stats = main.run(
+                params, deploy=True, output_path=os.path.join(output_dir, f"{name}.csv")
+            )
+            elapsed = time.perf_counter() - start
+    if stats["frames"] == 0:
+        raise RuntimeError(f"No frames could be read from {job['video']}")
+
+    rpms = stats["rpms"]
+    mean_rpm = float(np.mean(rpms)) if rpms else None
+    real_rpm = params.get("real_rpm")
+    error = (
+        utils.calculate_error_percentage(mean_rpm, real_rpm)
+        if mean_rpm is not None
+        else None
+    )
+    result = {
+        "name": name,
+        "video": job["video"],
+        "config": job["config"],
+        "frames": stats["frames"],
+        "seconds": round(elapsed, 3),
+        "frames_per_second": round(stats["frames"] / max(elapsed, 1e-9), 1),
+        "mean_rpm": None if mean_rpm is None else round(mean_rpm, 3),
+        "real_rpm": real_rpm,
+        "error_percentage": None if error is None else round(error, 3),
+    }
+
+    # Written last and in one go, its existence marks the job as done
+    path = result_path(output_dir, name)
+    with open(f"{path}.tmp", "w") as result_file:
+        json.dump(result, result_file, indent=2)
+    os.replace(f"{path}.tmp", path)
+    return result
+
+
+def describe(result: dict) -> str:
+    text = f"{result['frames']} frames, {result['frames_per_second']} frames/s"
+    if result["mean_rpm"] is not None:
+        text += f", RPM {result['mean_rpm']}"
+    if result["error_percentage"] is not None:
+        text += f", error {result['error_percentage']}%"
+    return text
+
+
+def write_summary(output_dir: str, jobs: list[dict], results: dict, failed: dict):
+    rows = []
+    for job in jobs:
+        if job["name"] in results:
+            result = {**results[job["name"]], "status": "done"}
+            rows.append([result.get(column) for column in SUMMARY_COLUMNS])
+        else:
+            status = failed.get(job["name"], "not run")
+            rows.append([job["name"]] + [None] * (len(SUMMARY_COLUMNS) - 2) + [status])
+
+    with open(os.path.join(output_dir, "summary.csv"), "w", newline="") as out_file:
+        writer = csv.writer(out_file)
+        writer.writerow(SUMMARY_COLUMNS)
+        writer.writerows(rows)
+
+    cells = [SUMMARY_COLUMNS] + [
+        ["" if cell is None else str(cell) for cell in row] for row in rows
+    ]
+    widths = [max(len(row[i]) for row in cells) for i in range(len(SUMMARY_COLUMNS))]
+    for row in cells:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+
+
+def run_batch(
+    jobs: list[dict], output_dir: str, workers: int | None = None, rerun: bool = False
+) -> None:
+    os.makedirs(output_dir, exist_ok=True)
+    results = {}
+    pending = []
+    for job in jobs:
+        path = result_path(output_dir, job["name"])
+        if os.path.exists(path) and not rerun:
+            with open(path) as result_file:
+                results[job["name"]] = json.load(result_file)
+        else:
+            pending.append(job)
+
+    workers = workers or os.cpu_count() or 1
+    print(
+        f"{len(jobs)} jobs, {len(results)} already done, "
+        f"running {len(pending)} on {workers} processes"
+    )
+
+    failed = {}
+    start = time.perf_counter()
+    frames = 0
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=init_worker)
+    try:
+        futures = {pool.submit(run_job, job, output_dir): job for job in pending}
+        for done, future in enumerate(as_completed(futures), 1):
+            name = futures[future]["name"]
+            try:
+                result = future.result()
+            except Exception as error:
+                failed[name] = f"failed: {error}"
+                print(f"[{done}/{len(pending)}] {name} failed: {error}")
+                continue
+            results[name] = result
+            frames += result["frames"]
+            print(f"[{done}/{len(pending)}] {name}: {describe(result)}")
+    finally:
+        # Finished jobs keep their results, the rest run again next time
+        pool.shutdown(cancel_futures=True)
+
+    elapsed = time.perf_counter() - start
+    if pending:
+        print(
+            f"Processed {frames} frames in {round(elapsed, 1)} s "
+            f"({round(frames / max(elapsed, 1e-9), 1)} frames/s over all processes)"
+        )
+    write_summary(output_dir, jobs, results, failed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("manifest")
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        default="runs/batch",
+        help="Where the rows, logs and results of every job go",
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of processes, one per core by default",
+    )
+    parser.add_argument(
+        "--rerun",
+        action="store_true",
+        help="Run jobs again even if they have results",
+    )
+    args = parser.parse_args()
+    run_batch(load_manifest(args.manifest), args.output_dir, args.workers, args.rerun)
@@ -0,0 +1,465 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import cv2 as cv
+import numpy as np
+from rpm import bpm_cascade
+from rpm import opticalflow
+from rpm import pipeline
+from rpm import utils
+
+# --------Benchmarks--------
+# Runs a config against its target (normally a recorded clip) with different settings
+# and prints the per-frame cost of each. Usage:
+# python benchmark.py config/yourconfig.json <benchmark> [-n max_frames]
+
+
+def time_optical_flow(params: dict, max_frames: int) -> tuple[float, list[float]]:
+    if params["mode"] == "denseflow":
+        feed = opticalflow.DenseOpticalFlow(**params)
+    else:
+        feed = opticalflow.OpticalFlow(**params)
+    rpms = []
+    frames = 0
+    elapsed = 0.0
+
+    while feed.isActive and frames < max_frames:
+        start = time.perf_counter()
+        data, image = feed.get_optical_flow_vectors()
+        if image is None:
+            break
+        if all(x is not None for x in data) and len(data[0]) > 0:
+            rpm = feed.estimate_rpm(data[0], data[1])
+            if rpm is not None:
+                rpms.append(rpm)
+        elapsed += time.perf_counter() - start
+        frames += 1
+
+    feed.release()
+    return (elapsed / max(frames, 1) * 1000, rpms)
+
+
+def run_main_deployed(params: dict) -> tuple[float, list[str], str]:
+    # Runs main.py in deploy mode in a scratch directory and returns the wall time,
+    # the logged rows (frame tick first) and whatever was printed
+    main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    with tempfile.TemporaryDirectory() as workdir:
+        cfg_path = os.path.join(workdir, "cfg.json")
+        with open(cfg_path, "w") as cfg_file:
+            # With every column logged, the RPM is always the 4th
+            logged = {"log_frame_ticks": True, "log_timestamps": True}
+            json.dump({**params, **logged, "log_color_values": True}, cfg_file)
+
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, main_path, cfg_path, "-d"],
+            cwd=workdir,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        elapsed = time.perf_counter() - start
+
+        with open(os.path.join(workdir, "runs", "out.csv")) as out_file:
+            rows = [line for line in out_file if not line.startswith("Logging")]
+    return (elapsed, rows, result.stdout)
+
+
+def write_synthetic_turbine(
+    path: str, params: dict, fps: float, rpm: float, seconds: float
+) -> None:
+    # Three bright blades on a noisy background, hub in the middle of the crop
+    if params["crop_points"] is None:
+        (y1, y2), (x1, x2) = (0, 360), (0, 400)
+    else:
+        (y1, y2), (x1, x2) = params["crop_points"]
+    width, height = x2 + 20, y2 + 20
+    hub = ((x1 + x2) // 2, (y1 + y2) // 2)
+    blade_length = int(np.hypot(x2 - x1, y2 - y1) / 2)
+    thickness = max(4, (x2 - x1) // 32)
+
+    writer = cv.VideoWriter(path, cv.VideoWriter_fourcc(*"MJPG"), fps, (width, height))
+    rng = np.random.default_rng(0)
+    for i in range(int(seconds * fps)):
+        image = np.full((height, width, 3), (180, 140, 90), dtype=np.uint8)
+        angle = 2 * np.pi * rpm / 60 * i / fps
+        for blade in range(3):
+            a = angle + blade * 2 * np.pi / 3
+            tip = (
+                int(hub[0] + blade_length * np.cos(a)),
+                int(hub[1] - blade_length * np.sin(a)),
+            )
+            cv.line(image, hub, tip, (240, 240, 240), thickness)
+        image = cv.add(image, rng.integers(0, 8, image.shape, dtype=np.uint8))
+        writer.write(image)
+    writer.release()
+
+
+def print_result(label: str, ms_per_frame: float, rpms: list, real_rpm) -> None:
+    mean_rpm = float(np.mean(rpms)) if rpms else float("nan")
+    error = utils.calculate_error_percentage(mean_rpm, real_rpm)
+    print(
+        f"{label:<40} {ms_per_frame:8.3f} ms/frame   RPM: {round(mean_rpm, 3)}"
+        + ("" if error is None else f"   Error: {round(error, 2)}%")
+    )
+
+
+def bench_flow_grayscale(params: dict, max_frames: int) -> None:
+    # Converting every frame to grayscale twice vs. reusing the previous conversion
+    for reuse in (False, True):
+        ms, rpms = time_optical_flow(
+            {**params, "mode": "opticalflow", "reuse_flow_grayscale": reuse},
+            max_frames,
+        )
+        print_result(f"reuse_flow_grayscale={reuse}", ms, rpms, params["real_rpm"])
+
+
+def bench_flow_warp(params: dict, max_frames: int) -> None:
+    # Warping every frame vs. warping only the tracked points (RECT crops only)
+    for warp_points in (False, True):
+        ms, rpms = time_optical_flow(
+            {**params, "mode": "opticalflow", "warp_tracked_points": warp_points},
+            max_frames,
+        )
+        print_result(f"warp_tracked_points={warp_points}", ms, rpms, params["real_rpm"])
+
+
+def bench_flow_estimator(params: dict, max_frames: int) -> None:
+    # Mean magnitude over radius_max vs. per-point angular velocity, at a few feature budgets
+    for max_corners in (10, 25, 100):
+        for estimator in ("magnitude", "angular"):
+            ms, rpms = time_optical_flow(
+                {
+                    **params,
+                    "mode": "opticalflow",
+                    "flow_estimator": estimator,
+                    "max_corners": max_corners,
+                },
+                max_frames,
+            )
+            print_result(
+                f"{estimator}, max_corners={max_corners}",
+                ms,
+                rpms,
+                params["real_rpm"],
+            )
+            if rpms:
+                print(f"{'':<40} RPM std over frames: {round(float(np.std(rpms)), 3)}")
+
+
+def bench_flow_dense(params: dict, max_frames: int) -> None:
+    # Sparse Shi-Tomasi + LK vs. dense flow on a downscaled annulus
+    runs = [
+        ("sparse, angular", {"mode": "opticalflow", "flow_estimator": "angular"}),
+        ("dense, dis", {"mode": "denseflow", "dense_flow_algorithm": "dis"}),
+        (
+            "dense, farneback",
+            {"mode": "denseflow", "dense_flow_algorithm": "farneback"},
+        ),
+    ]
+    for label, overrides in runs:
+        ms, rpms = time_optical_flow({**params, **overrides}, max_frames)
+        print_result(label, ms, rpms, params["real_rpm"])
+        if rpms:
+            print(f"{'':<40} RPM std over frames: {round(float(np.std(rpms)), 3)}")
+
+
+def bench_bpm_spectral(params: dict, max_frames: int) -> None:
+    # Cost of the spectral estimator next to the morphology that produces its input
+    feed = bpm_cascade.BpmCascade(**{**params, "mode": "bpm"})
+    bounds = feed.cascade_bounding_boxes(*feed.get_fitted_box_params_from_cfg())
+    engine = feed.create_cascade_engine(bounds, *feed.get_dilation_erosion_params())
+    feed.process_rpm_bounds()
+    spectral = feed.create_spectral_estimator()
+
+    frame = feed.get_frame()
+    morphology_time, spectral_time = 0.0, 0.0
+    rpms = []
+    frames = 0
+    while feed.isActive and frames < max_frames:
+        start = time.perf_counter()
+        intensities = engine.process(frame)
+        morphology_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        spectral.insert(intensities)
+        if feed.frame_cnt % feed.spectral_update_interval == 0:
+            rpm = spectral.estimate()
+            if rpm is not None:
+                rpms.append(rpm)
+        spectral_time += time.perf_counter() - start
+
+        frame = feed.get_frame()
+        frames += 1
+    feed.release()
+
+    frames = max(frames, 1)
+    print_result("morphology", morphology_time / frames * 1000, [], None)
+    print_result(
+        f"spectral, window={feed.spectral_window}s",
+        spectral_time / frames * 1000,
+        rpms,
+        params["real_rpm"],
+    )
+
+
+def compare_gated_runs(params: dict, runs: list[tuple[str, dict]]) -> None:
+    # Deployed runs with different gating settings against an ungated reference run.
+    # The ticks (frame and RPM) should match, the benchmark fails if they don't
+    ungated = {"coarse_gate_fraction": 0, "predictive_gating": False}
+    _, reference_rows, _ = run_main_deployed({**params, **ungated})
+    reference_ticks = [(row.split(",")[0], row.split(",")[3]) for row in reference_rows]
+    changed = []
+    for label, overrides in [("ungated", ungated)] + runs:
+        elapsed, rows, stdout = run_main_deployed({**params, **ungated, **overrides})
+        ticks = [(row.split(",")[0], row.split(",")[3]) for row in rows]
+        if ticks != reference_ticks:
+            changed.append(label)
+        print(
+            f"{label:<40} {elapsed:8.3f} s   "
+            f"{len(ticks)} ticks, {'unchanged' if ticks == reference_ticks else 'CHANGED'}"
+        )
+        for line in stdout.splitlines():
+            if line.startswith(("Gating", "Predicted")):
+                print(f"{'':<40} {line}")
+    if changed:
+        sys.exit(f"Gating changed the ticks with {', '.join(changed)}")
+
+
+def bench_bpm_coarse(params: dict, max_frames: int) -> None:
+    # Morphology only when the raw box means get close to the threshold
+    compare_gated_runs(
+        params,
+        [
+            (f"coarse_gate_fraction={fraction}", {"coarse_gate_fraction": fraction})
+            for fraction in (0.1, 0.25, 0.5)
+        ],
+    )
+
+
+def bench_bpm_predictive(params: dict, max_frames: int) -> None:
+    # Morphology only around the predicted blade passes. The tracker also sets the
+    # detection lockout, so a few ticks may legitimately move, check which ones
+    compare_gated_runs(
+        params,
+        [
+            (
+                f"predictive_window={window}",
+                {"predictive_gating": True, "predictive_window": window},
+            )
+            for window in (0.1, 0.2, 0.3)
+        ]
+        + [
+            (
+                "predictive + coarse_gate_fraction=0.25",
+                {"predictive_gating": True, "coarse_gate_fraction": 0.25},
+            )
+        ],
+    )
+
+
+def bench_bpm_subframe(params: dict, max_frames: int) -> None:
+    # RPM accuracy of whole-frame vs. sub-frame ticks at a range of capture fps, on a
+    # synthetic clip whose blade-pass period is not a whole number of frames
+    rpm = 17.3
+    with tempfile.TemporaryDirectory() as workdir:
+        for fps in (10, 15, 20, 30):
+            target = os.path.join(workdir, f"synthetic_{fps}.avi")
+            write_synthetic_turbine(target, params, fps, rpm, seconds=60)
+            # Settings given in frames are meant for the config's own fps
+            scale = fps / params["fps"]
+            for subframe in (False, True):
+                _, rows, _ = run_main_deployed(
+                    {
+                        **params,
+                        "target": target,
+                        "fps": fps,
+                        "frame_buffer_size": max(
+                            1, round(params["frame_buffer_size"] * scale)
+                        ),
+                        "color_delta_update_frequency": max(
+                            1, round(params["color_delta_update_frequency"] * scale)
+                        ),
+                        "real_rpm": rpm,
+                        "coarse_gate_fraction": 0,
+                        "predictive_gating": False,
+                        "subframe_ticks": subframe,
+                    }
+                )
+                # Leave out the first half, the rpm buffer and thresholds are settling
+                rpms = [float(row.split(",")[3]) for row in rows][len(rows) // 2 :]
+                errors = [abs(value - rpm) / rpm * 100 for value in rpms]
+                print(
+                    f"{f'fps={fps}, subframe_ticks={subframe}':<40} "
+                    f"mean error: {round(float(np.mean(errors)), 3)}%   "
+                    f"max error: {round(float(np.max(errors)), 3)}%"
+                    if errors
+                    else f"{f'fps={fps}, subframe_ticks={subframe}':<40} no output"
+                )
+
+
+def bench_bpm_decimation(params: dict, max_frames: int) -> None:
+    # Full rate vs. adaptive decimation, with and without sub-frame ticks
+    for decimate in (False, True):
+        for subframe in (False, True):
+            elapsed, rows, stdout = run_main_deployed(
+                {
+                    **params,
+                    "adaptive_decimation": decimate,
+                    "subframe_ticks": subframe,
+                }
+            )
+            rpms = [float(row.split(",")[3]) for row in rows][len(rows) // 2 :]
+            mean_rpm = float(np.mean(rpms)) if rpms else float("nan")
+            error = utils.calculate_error_percentage(mean_rpm, params["real_rpm"])
+            print(
+                f"{f'decimation={decimate}, subframe={subframe}':<40} {elapsed:8.3f} s   "
+                f"RPM: {round(mean_rpm, 3)}"
+                + ("" if error is None else f"   Error: {round(error, 2)}%")
+            )
+            for line in stdout.splitlines():
+                if line.startswith("Decimation"):
+                    print(f"{'':<40} {line}")
+
+
+def bench_bpm_resolution(params: dict, max_frames: int) -> None:
+    # Fixed processing scales on a synthetic clip. Its blade-pass period is not a whole
+    # number of frames, so the RPM changes and gets logged on every tick. A zero budget
+    # makes the controller step down to the only other scale right after the first frame
+    rpm = 17.3
+    with tempfile.TemporaryDirectory() as workdir:
+        target = os.path.join(workdir, "synthetic.avi")
+        write_synthetic_turbine(target, params, params["fps"], rpm, seconds=60)
+        for scale in (1.0, 0.75, 0.5, 0.25):
+            elapsed, rows, _ = run_main_deployed(
+                {
+                    **params,
+                    "target": target,
+                    "real_rpm": rpm,
+                    "resolution_scaling": scale != 1,
+                    "resolution_scales": [scale],
+                    "resolution_budget": 0,
+                    "resolution_check_interval": 1,
+                }
+            )
+            rpms = [float(row.split(",")[3]) for row in rows][len(rows) // 2 :]
+            mean_rpm = float(np.mean(rpms)) if rpms else float("nan")
+            error = utils.calculate_error_percentage(mean_rpm, rpm)
+            print(
+                f"{f'resolution scale={scale}':<40} {elapsed:8.3f} s   "
+                f"{len(rows)} rows   RPM: {round(mean_rpm, 3)}"
+                + ("" if error is None else f"   Error: {round(error, 2)}%")
+            )
+
+
+def bench_bpm_multi(params: dict, max_frames: int) -> None:
+    # Three turbines (the same crop three times): three separate runs, which decode
+    # the video three times, against one multi-turbine run with and without threads
+    count = 3
+    elapsed = sum(run_main_deployed(params)[0] for _ in range(count))
+    print(f"{f'{count} separate runs':<40} {elapsed:8.3f} s")
+
+    main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    for workers in (1, count):
+        config = {
+            **params,
+            "turbines": [{"id": i} for i in range(count)],
+            "turbine_workers": workers,
+        }
+        with tempfile.TemporaryDirectory() as workdir:
+            cfg_path = os.path.join(workdir, "cfg.json")
+            with open(cfg_path, "w") as cfg_file:
+                json.dump(config, cfg_file)
+            start = time.perf_counter()
+            subprocess.run(
+                [sys.executable, main_path, cfg_path, "-d"],
+                cwd=workdir,
+                capture_output=True,
+                check=True,
+            )
+            elapsed = time.perf_counter() - start
+        print(f"{f'multi-turbine, turbine_workers={workers}':<40} {elapsed:8.3f} s")
+
+
+def bench_bpm_pipeline(params: dict, max_frames: int) -> None:
+    # The serial loop against the staged pipeline, which should log the same ticks.
+    # The serial run gets the config the pipeline runs with
+    serial = {**pipeline.pipeline_params(params), "pipeline": False}
+    elapsed, reference_rows, _ = run_main_deployed(serial)
+    reference_ticks = [(row.split(",")[0], row.split(",")[3]) for row in reference_rows]
+    print(f"{'serial':<40} {elapsed:8.3f} s   {len(reference_ticks)} ticks")
+    for queue_size in (1, 4, 16):
+        elapsed, rows, stdout = run_main_deployed(
+            {**params, "pipeline": True, "pipeline_queue_size": queue_size}
+        )
+        ticks = [(row.split(",")[0], row.split(",")[3]) for row in rows]
+        print(
+            f"{f'pipeline, queue size={queue_size}':<40} {elapsed:8.3f} s   "
+            f"{len(ticks)} ticks, {'unchanged' if ticks == reference_ticks else 'CHANGED'}"
+        )
+        for line in stdout.splitlines():
+            if line.startswith("Pipeline"):
+                print(f"{'':<40} {line}")
+
+
+def bench_bpm_shards(params: dict, max_frames: int) -> None:
+    # One long synthetic clip, serial and split into time shards. The shards warm up
+    # on the minute(s) before them, so the rows (frame and RPM) should match. The RPMs
+    # are compared rounded, rolling sums restarted in a shard differ in the last bits
+    rpm = 17.3
+    with tempfile.TemporaryDirectory() as workdir:
+        target = os.path.join(workdir, "synthetic.avi")
+        write_synthetic_turbine(target, params, params["fps"], rpm, seconds=300)
+        config = {**params, "target": target, "real_rpm": rpm}
+        elapsed, reference_rows, _ = run_main_deployed(config)
+        reference = [
+            (row.split(",")[0], round(float(row.split(",")[3]), 6))
+            for row in reference_rows
+        ]
+        print(f"{'serial':<40} {elapsed:8.3f} s   {len(reference)} rows")
+        for shards in (2, 4, 8):
+            elapsed, rows, _ = run_main_deployed({**config, "time_shards": shards})
+            ticks = [
+                (row.split(",")[0], round(float(row.split(",")[3]), 6)) for row in rows
+            ]
+            print(
+                f"{f'time_shards={shards}':<40} {elapsed:8.3f} s   {len(ticks)} rows, "
+                f"{'unchanged' if ticks == reference else 'CHANGED'}"
+            )
+
+
+BENCHMARKS = {
+    "flow-grayscale": bench_flow_grayscale,
+    "flow-warp": bench_flow_warp,
+    "flow-estimator": bench_flow_estimator,
+    "flow-dense": bench_flow_dense,
+    "bpm-spectral": bench_bpm_spectral,
+    "bpm-coarse": bench_bpm_coarse,
+    "bpm-predictive": bench_bpm_predictive,
+    "bpm-subframe": bench_bpm_subframe,
+    "bpm-decimation": bench_bpm_decimation,
+    "bpm-resolution": bench_bpm_resolution,
+    "bpm-multi": bench_bpm_multi,
+    "bpm-pipeline": bench_bpm_pipeline,
+    "bpm-shards": bench_bpm_shards,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cfg")
+    parser.add_argument("benchmark", choices=BENCHMARKS.keys())
+    parser.add_argument(
+        "-n",
+        "--max-frames",
+        type=int,
+        default=1000,
+        help="Stop each run after this many frames",
+    )
+    args = parser.parse_args()
+    params = utils.parse_json(args.cfg)
+    BENCHMARKS[args.benchmark](params, args.max_frames)
@@ -2,9 +2,14 @@ import os
 from datetime import datetime
 import cv2 as cv
 import numpy as np
-from collections import deque
 from rpm import opticalflow
 from rpm import bpm_cascade
+from rpm import bpm_runner
+from rpm import multi_turbine
+from rpm import pipeline
+from rpm import polar
+from rpm import publisher
+from rpm import time_shards
 from rpm import utils
 import argparse
 
@@ -13,7 +18,7 @@ import argparse
 # Look at rpm/opticalflow.py and rpm/calculate_rpm.py for details
 
 
-def main(feed, params, start_time):
+def main(feed, params, start_time, deploy=False, output_file=None):
     # TODO: refactor the entirety of opticalflow.py
     # Flow method setup
     rpms = []
@@ -30,15 +35,11 @@ def main(feed, params, start_time):
 
                 # if tracking is successful, data will not have None
                 if all(x is not None for x in data):
-                    motion_vectors = data[0] - data[1]
-                    scaled_vectors = motion_vectors * feed.rpm_scaling_factor
-                    rpm = feed.calculate_rpm_from_vectors(scaled_vectors)
-                    flow_image = feed.draw_optical_flow(image, data[1], data[0])
+                    rpm = feed.estimate_rpm(data[0], data[1])
 
                 # Set some defaults that we filter out if tracking is unsuccessful
                 else:
                     rpm = None
-                    flow_image = image
 
                 # Find RPM and error rate
                 if rpm is not None:
@@ -46,182 +47,176 @@ def main(feed, params, start_time):
                     error = utils.calculate_error_percentage(rpm, params["real_rpm"])
                     errors.append(error)
 
-                cv.imshow("Image feed", flow_image)
-                k = cv.waitKey(0) & 0xFF
-                if k == 27:
-                    break
+                # Deployed estimators run headless, e.g. next to bpm on a frame bus
+                if not deploy:
+                    flow_image = image
+                    if all(x is not None for x in data):
+                        flow_image = feed.draw_optical_flow(image, data[1], data[0])
+                    cv.imshow("Image feed", flow_image)
+                    k = cv.waitKey(0) & 0xFF
+                    if k == 27:
+                        break
 
             else:
-                if args.deploy:
-                    utils.write_output(params["id"], 0, rpms, params["real_rpm"])
+                if deploy:
+                    utils.write_output(output_file, 0, rpms, params["real_rpm"])
                 break
 
-    elif isinstance(feed, bpm_cascade.BpmCascade):
-        frame = feed.get_frame()
+        if feed.track_features:
+            print(f"Feature re-detection rate: {round(feed.redetection_rate(), 3)}")
 
-        # Region and processing setup
-        box_params = feed.get_fitted_box_params_from_cfg()
-        bounds = feed.cascade_bounding_boxes(*box_params)
-        kernel_er_dil_params = feed.get_dilation_erosion_params()
+    elif isinstance(feed, polar.PolarPhaseTracker):
+        rpm_buffer = utils.RollingStatistics(
+            maxlen=params["rpm_buffer_length"], track_mode=False
+        )
+        while True:
+            frame = feed.get_frame()
+            if not feed.isActive:
+                if deploy:
+                    utils.write_output(output_file, 0, rpms, params["real_rpm"])
+                break
 
-        # Filtering setup
-        # deque for ease of use, we only need the last 2 ticks to measure tick time
-        frame_ticks = deque(maxlen=2)
-        fb_average_long_buffer = deque(maxlen=int(params["fps"] * 60))
-        rpm_buffer = deque(maxlen=params["rpm_buffer_length"])
-        deviation, mode = 0, 0
-        prev_rpm, rpm = 0, 0
-        feed.process_rpm_bounds()
+            # One estimate per frame, from the blade rotation since the previous frame
+            rpm = feed.estimate_rpm(frame)
+            if rpm is not None:
+                rpms.append(rpm)
+                rpm_buffer.append(rpm)
 
-        while True:
-            if feed.isActive:
-                # To start, we loop through each bounding box and look at its contents
-                # Each box gets its own frame buffer
-                for bounding_box in bounds.values():
-                    # Process the region within the box
-                    processed_region = bounding_box.dilate_and_erode(
-                        frame, *kernel_er_dil_params
-                    )
-
-                    # Save processed regions/subimages in frame buffer
-                    bounding_box.fb.insert(processed_region)
-
-                    #  Draw a  border around the bounding box processed region
-                    #  call this after inserting the region into the frame buffer!!!!
-                    #  if not we do computations on the region WITH borders drawn on
-                    if not args.deploy:
-                        bounding_box.draw.border_around_region(
-                            processed_region, 1, [0, 255, 0]
-                        )
-                        # Draw processing
-                        frame = bounding_box.draw.processing_results(
-                            frame, bounding_box.region, processed_region
-                        )
-
-                    bounding_box.fb.update_color_delta_average()
-
-                # Update decection values
-                if feed.frame_cnt % feed.color_delta_update_frequency == 0:
-                    feed.update_global_fb_average()
-                    fb_average_long_buffer.append(feed.all_fb_delta_average)
-                    mode = utils.find_top_n_modes(fb_average_long_buffer, 1)
-
-                    # Only useful if there is more than 1 mode
-                    mode = np.mean(mode)
-                    deviation = np.std(fb_average_long_buffer)
-
-                # Check if the new values indicate a detection
-                if feed.blade_detection_in_box_regions(float(deviation), float(mode)):
-                    # Note the frame we detect the blade
-                    frame_ticks.append(feed.frame_cnt)
-
-                    # We cant do calculations with one detection
-                    if len(frame_ticks) == 2:
-                        rpm = feed.calculate_rpm(
-                            frame_ticks[1] - frame_ticks[0], feed.fps
-                        )
-
-                        # Ignore detections if they are unreasonable.
-                        # The tick has been stored but the output is not updated
-                        if rpm_buffer:
-
-                            # Turbines wont spin faster than 35RPM. they will not "brake"
-                            # faster than a loss of 3 RPM per third of a rotation.
-                            # Detections saying otherwise are assumed false.
-                            if feed.rpm_within_bounds(rpm, prev_rpm):
-                                rpm_buffer.append(rpm)
-
-                        # The first detection we append anyway
-                        else:
-                            rpm_buffer.append((rpm if rpm < 30 else 0))
-
-                    # Stop additional triggers until we've stabilized
-                    feed.detection_enable_toggle = False
-
-                feed.update_detection_enable_toggle(
-                    feed.all_fb_delta_average, deviation, mode, frame_ticks
+            if not deploy:
+                print(
+                    f"Frame: {feed.frame_cnt} - RPM: {round(rpm_buffer.mean, 3)} - "
+                    f"Correlation: {round(feed.correlation, 3)}"
                 )
+                cv.imshow("Image feed", feed.draw_annulus(frame))
+                k = cv.waitKey(1) & 0xFF
+                if k == 27:
+                    break
 
-                # Write, print and other final steps
-                if args.deploy:
-                    if feed.frame_cnt % 1000 == 0:
-                        print("RPM calculation is running...")
-
-                    # Only append new values
-                    if rpm != prev_rpm:
-                        tick_timestamp = datetime.now()
-                        output_file.write(
-                            utils.dynamic_log_string(
-                                feed,
-                                tick_timestamp,
-                                (
-                                    feed.all_fb_delta_average,
-                                    mode,
-                                    (mode + feed.threshold_multiplier * deviation),
-                                ),
-                                rpm_buffer,
-                                print_error=True,
-                                real_rpm=feed.real_rpm,
-                            )
-                        )
-                else:
-                    smoothed_rpm = [round(np.mean(rpm_buffer), 3)]
-                    feed.print_useful_stats(
-                        out=smoothed_rpm,
-                        frame_ticks=frame_ticks,
-                        detection_enable_toggle=feed.detection_enable_toggle,
-                        threshold=(mode + feed.threshold_multiplier * deviation),
-                        mode=mode,
-                    )
-
-                    cv.imshow("Image feed", frame)
-                    k = cv.waitKey(1) & 0xFF
+    elif isinstance(feed, bpm_cascade.BpmCascade) and params.get("pipeline", False):
+        runner = bpm_runner.BpmRunner(feed, params, deploy, output_file)
+        frame_pipeline = pipeline.BpmPipeline(
+            runner, params.get("pipeline_queue_size", 4)
+        )
+        frame_pipeline.run()
+        runner.finish()
+        frame_pipeline.print_metrics()
+        rpms = runner.logged_rpms
 
-                    if k == 27:
-                        break
+    elif isinstance(feed, bpm_cascade.BpmCascade):
+        frame = feed.get_frame()
+        runner = bpm_runner.BpmRunner(feed, params, deploy, output_file)
+        while feed.isActive:
+            display_frame = runner.process(frame)
+            if not deploy:
+                cv.imshow("Image feed", display_frame)
+                k = cv.waitKey(1) & 0xFF
 
-                # Update the frame and set rpm to prev_rpm
-                frame = feed.get_frame()
-                prev_rpm = rpm
+                if k == 27:
+                    break
 
-            else:
-                break
+            # Update the frame
+            frame = feed.get_frame()
 
+        runner.finish()
+        rpms = runner.logged_rpms
 
-if __name__ == "__main__":
-    np.set_printoptions(threshold=np.inf)
-    parser = argparse.ArgumentParser()
-    parser.add_argument("cfg")
-    parser.add_argument(
-        "-d",
-        "--deploy",
-        action="store_true",
-        required=False,
-        help="",
-    )
-    args = parser.parse_args()
-    params = utils.parse_json(args.cfg)
+    return rpms
 
+
+def run(params, deploy=False, output_path="runs/out.csv"):
+    """
+    One run of a config: creates the feed, runs it to the end and writes rows to
+    output_path in deploy mode. Returns the frame count and the RPM estimates.
+    """
     current_time = datetime.now()
     current_time_string = current_time.strftime("%d/%m/%Y %H:%M:%S")
 
     # Open this file globally in production mode to avoid excessive open/closes
-    if args.deploy:
-        os.makedirs(os.path.dirname("runs/out.csv"), exist_ok=True)
-        output_file = open("runs/out.csv", "w", buffering=1)
+    output_file = None
+    if deploy:
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        output_file = open(output_path, "w", buffering=1)
         output_file.write(f"Logging started at {current_time_string}\n")
 
     # restart the feed for every run
-    if params["mode"] == "bpm":
+    if params["mode"] == "bpm" and params.get("pipeline", False):
+        feed = bpm_cascade.BpmCascade(**pipeline.pipeline_params(params))
+    elif params["mode"] == "bpm":
         feed = bpm_cascade.BpmCascade(**params)
+    elif params["mode"] == "denseflow":
+        feed = opticalflow.DenseOpticalFlow(**params)
+    elif params["mode"] == "polar":
+        feed = polar.PolarPhaseTracker(**params)
     else:
         feed = opticalflow.OpticalFlow(**params)
 
-    main(feed, params, current_time)
+    rpms = main(feed, params, current_time, deploy, output_file)
+
+    prefetch_stats = feed.prefetch_stats()
+    if prefetch_stats is not None:
+        print(f"Frame prefetch: {prefetch_stats}")
+    bus_stats = feed.bus_stats()
+    if bus_stats is not None:
+        print(f"Frame bus: {bus_stats}")
+    if feed.drop_late_frames:
+        print(f"Live feed: {feed.live_stats()}")
+    feed.release()
 
-    if args.deploy:
+    if deploy:
         end_time = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
         output_file.write(f"Logging ended at {end_time}\n")
+        output_file.close()
 
     else:
         cv.destroyAllWindows()
+    return {"frames": feed.frame_cnt, "rpms": rpms}
+
+
+if __name__ == "__main__":
+    np.set_printoptions(threshold=np.inf)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cfg")
+    parser.add_argument(
+        "-d",
+        "--deploy",
+        action="store_true",
+        required=False,
+        help="",
+    )
+    parser.add_argument(
+        "-p",
+        "--publish",
+        action="store_true",
+        required=False,
+        help="Run the capture process of the config's frame_bus",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default="runs/out.csv",
+        help="Where rows are written in deploy mode. With turbines, the out_<id>.csv "
+        "files go into its directory",
+    )
+    args = parser.parse_args()
+    params = utils.parse_json(args.cfg)
+
+    # Only capture, estimators attach to the frame bus from their own processes
+    if args.publish:
+        feed = publisher.FramePublisher(**params)
+        feed.run()
+        feed.release()
+        raise SystemExit
+
+    # Several turbines in one video, decoded once and written to one file each
+    if "turbines" in params:
+        multi_turbine.run(params, args.deploy, os.path.dirname(args.output) or ".")
+        if not args.deploy:
+            cv.destroyAllWindows()
+        raise SystemExit
+
+    # One long video split into time shards, processed in parallel
+    if params.get("time_shards", 1) > 1:
+        time_shards.run(params, args.deploy, args.output)
+        raise SystemExit
+
+    run(params, args.deploy, args.output)
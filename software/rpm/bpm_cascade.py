@@ -2,8 +2,10 @@ import cv2 as cv
 from . import utils
 import numpy as np
 from . import calculate_rpm as crpm
+from .spectral import SpectralRpmEstimator
 from .feed import feed
 import math
+import time
 from collections import deque
 
 
@@ -19,7 +21,7 @@ class BoundingBox:
 
     """
 
-    def __init__(self, center, size, region, frame_buffer_size, id):
+    def __init__(self, center, size, region, id):
         self.center = center
         self.size = size
 
@@ -28,9 +30,7 @@ class BoundingBox:
         #  side length =/= size
         self.side_length = self.size * 2
         self.draw = feed.Draw(self)
-        self.fb = FrameBuffer(self, frame_buffer_size)
         self.id = id
-        self.rank = 0
 
     def dilate_and_erode(
         self,
@@ -49,14 +49,14 @@ class BoundingBox:
         return self.side_length * self.side_length
 
     @classmethod
-    def from_center_and_size(cls, center, size, frame_buffer_size, id):
+    def from_center_and_size(cls, center, size, id):
         region = cls.region_from_center_and_size(center, size)
-        return cls(center, size, region, frame_buffer_size, id)
+        return cls(center, size, region, id)
 
     @classmethod
-    def from_region(cls, region, frame_buffer_size, id):
+    def from_region(cls, region, id):
         center, size = cls.center_and_size_from_region(region)
-        return cls(center, size, region, frame_buffer_size, id)
+        return cls(center, size, region, id)
 
     @staticmethod
     def region_from_center_and_size(
@@ -81,43 +81,310 @@ class BoundingBox:
 
 class FrameBuffer:
     """
-    A wrapper class for initialized deques. Contains methods that simplify the trivial stuff.
+    Ring buffer of per-box intensities, one column per bounding box. Keeps the last
+    `size` frames so that the average intensity delta of every box updates in O(1).
+
+    The deltas are never stored: the sum of the last N deltas telescopes to
+    (newest intensity - intensity N frames ago), so it does not drift over long runs.
 
     Args:
         parent (class): The composition parent.
+        size (int): how many capture frames of deltas to average over, frames left out
+            by decimation included.
+        width (int): number of boxes.
+        store_subregions (bool): also keep copies of the processed box regions (memory heavy).
+        history (int): extra rows kept beyond the ones the average needs, so that many
+            inserts can be rewound and redone with exact deltas.
 
     """
 
-    def __init__(self, parent, size):
+    def __init__(self, parent, size, width=1, store_subregions=False, history=0):
         self.parent = parent
-        self.average_delta = 0
-        self.entries = deque(maxlen=size)
-
-    def insert(self, region: np.ndarray) -> None:
-        # Store the processed regions and nice-to-haves in the buffer
-        intensity = np.mean(region)
-
-        if len(self.entries) > 0:
-            prev_frame_intensity = self.entries[-1]["intensity"]
-            intensity_delta = intensity - prev_frame_intensity
-        else:
-            #  Setting these to 0 reduce startup spikes
-            intensity_delta = 0
+        self.size = size
+        self.count = 0
+        self.average_delta = np.zeros(width)
+
+        # One extra row holds the intensity right before the oldest delta
+        self.rows = size + 1 + history
+        self.intensities = np.zeros((self.rows, width))
+        self.frames = [0] * self.rows
+        # False for the rows of skipped frames, that only repeat older intensities
+        self.processed = [False] * self.rows
+        self.subregions = deque(maxlen=size) if store_subregions else None
+
+    def insert(
+        self,
+        intensities: np.ndarray,
+        regions: list[np.ndarray] | None = None,
+        frame: int | None = None,
+        processed: bool = True,
+    ) -> None:
+        # Store the box intensities with their frame number (the current frame if not
+        # given) and, if asked for, the processed regions
+        row = self.count % self.rows
+        self.intensities[row] = intensities
+        self.frames[row] = self.parent.frame_cnt if frame is None else frame
+        self.processed[row] = processed
+        self.count += 1
+
+        if self.subregions is not None and regions is not None:
+            self.subregions.append([region.copy() for region in regions])
+
+    def rewind(self, n: int) -> None:
+        # Forget the last n inserts, the next n inserts overwrite them
+        self.count -= min(n, self.count)
+
+    def delta_rows(self) -> tuple[int, int]:
+        # The rows of the newest intensity and of the one the average delta is taken
+        # against. The buffer averages over the last size capture frames. Frames left
+        # out by decimation have no row, so at a stride the oldest row is a more recent one
+        rows = self.rows
+        newest_frame = self.frames[(self.count - 1) % rows]
+        back = min(self.count - 1, self.size)
+        while (
+            back > 1
+            and self.frames[(self.count - 1 - back) % rows] < newest_frame - self.size
+        ):
+            back -= 1
+        return (self.count - 1) % rows, (self.count - 1 - back) % rows
 
-        entry = {
-            "subregion": region,
-            "intensity": intensity,
-            "intensity_delta": intensity_delta,
-        }
-        self.entries.append(entry)
+    def delta_is_exact(self) -> bool:
+        # Whether both rows of the average delta hold processed intensities
+        newest, oldest = self.delta_rows()
+        return self.processed[newest] and self.processed[oldest]
 
     # Only takes the last updated value and updates avgs
     # Designed this way so a user can conditionally update
     def update_color_delta_average(self) -> None:
-        vals = []
-        for entry in self.entries:
-            vals.append(entry["intensity_delta"])
-        self.average_delta = np.mean(vals)
+        if self.count == 0:
+            return
+
+        newest, oldest = self.delta_rows()
+        span = self.frames[newest] - self.frames[oldest]
+
+        #  The first delta is 0 to reduce startup spikes, so until the buffer is full
+        #  the deltas add up to (newest - first), over one frame more
+        if self.count <= self.size + 1 and oldest == 0:
+            span = min(span + 1, self.size)
+
+        self.average_delta = (
+            self.intensities[newest] - self.intensities[oldest]
+        ) / max(span, 1)
+
+
+class CascadeEngine:
+    """
+    Processes every bounding box of a cascade in one go. The kernel is built once,
+    the box regions are gathered into one preallocated mosaic with a gap between boxes,
+    and dilation/erosion run once over that mosaic. All box intensities then come out
+    of a single vectorized reduction.
+
+    The gap is wider than the reach of the kernel and is reset to a neutral value
+    before each operation, so every box is processed exactly as if it was processed
+    on its own (see BoundingBox.dilate_and_erode).
+
+    Args:
+        bounds (dict): the cascaded bounding boxes, all of the same size.
+        frame_size (tuple): (height, width) of the frames that will be processed.
+        kernel_size (tuple): erosion/dilation kernel size.
+        dil_it (int): dilation iterations.
+        er_it (int): erosion iterations.
+
+    """
+
+    def __init__(
+        self,
+        bounds: dict[str, BoundingBox],
+        frame_size: tuple[int, int],
+        kernel_size: tuple[int, int],
+        dil_it: int,
+        er_it: int,
+    ):
+        self.boxes = list(bounds.values())
+        self.num_boxes = len(self.boxes)
+        self.kernel = cv.getStructuringElement(cv.MORPH_RECT, kernel_size)
+        self.dil_it = dil_it
+        self.er_it = er_it
+        self.intensities = np.zeros(self.num_boxes)
+        self.processed_regions: list[np.ndarray] = []
+
+        # Regions may use negative (wrapping) slices, resolve them the same way numpy does
+        height, width = frame_size
+        rows = [range(height)[box.region[0]] for box in self.boxes]
+        cols = [range(width)[box.region[1]] for box in self.boxes]
+        self.side = self.boxes[0].side_length if self.boxes else 0
+
+        # Boxes that are clipped by the frame edge can't be stacked, process those one by one
+        self.fused = self.num_boxes > 0 and all(
+            len(r) == self.side and len(c) == self.side for r, c in zip(rows, cols)
+        )
+        if not self.fused:
+            return
+
+        # A rect kernel run N times is equivalent to one larger kernel
+        reach = max(
+            k + (max(it, 1) - 1) * (k - 1)
+            for k in kernel_size
+            for it in (dil_it, er_it)
+        )
+        self.stride = self.side + reach
+        self.src_rows = np.array([list(r) for r in rows]).T[:, :, np.newaxis]
+        self.src_rows = np.broadcast_to(
+            self.src_rows, (self.side, self.num_boxes, self.side)
+        ).reshape(self.side, -1)
+        self.src_cols = np.broadcast_to(
+            np.array([list(c) for c in cols]).reshape(1, -1),
+            (self.side, self.num_boxes * self.side),
+        )
+        box_offsets = np.arange(self.num_boxes) * self.stride
+        self.dst_cols = (box_offsets[:, np.newaxis] + np.arange(self.side)).reshape(-1)
+        self.canvas = None
+
+    def _allocate(self, frame: np.ndarray) -> None:
+        shape = (self.side, self.num_boxes * self.stride) + frame.shape[2:]
+        self.canvas = np.zeros(shape, dtype=frame.dtype)
+        self.dilated = np.zeros_like(self.canvas)
+        self.eroded = np.zeros_like(self.canvas)
+
+        # (side, box, column, [channel]) views into the mosaic
+        split_shape = (self.side, self.num_boxes, self.stride) + frame.shape[2:]
+        self.dilated_gaps = self.dilated.reshape(split_shape)[:, :, self.side :]
+        self.eroded_boxes = self.eroded.reshape(split_shape)[:, :, : self.side]
+        self.processed_regions = [
+            self.eroded[:, i * self.stride : i * self.stride + self.side]
+            for i in range(self.num_boxes)
+        ]
+        self.reduce_axes = (0,) + tuple(range(2, self.eroded_boxes.ndim))
+
+    def process(self, frame: np.ndarray) -> np.ndarray:
+        if not self.fused:
+            return self._process_per_box(frame)
+
+        if self.canvas is None or self.canvas.shape[2:] != frame.shape[2:]:
+            self._allocate(frame)
+
+        # The gaps in the canvas are never written to and stay 0, which dilation ignores
+        self.canvas[:, self.dst_cols] = frame[self.src_rows, self.src_cols]
+        cv.dilate(self.canvas, self.kernel, dst=self.dilated, iterations=self.dil_it)
+
+        # Erosion ignores 255
+        self.dilated_gaps[...] = 255
+        cv.erode(self.dilated, self.kernel, dst=self.eroded, iterations=self.er_it)
+
+        self.intensities = np.mean(self.eroded_boxes, axis=self.reduce_axes)
+        return self.intensities
+
+    def box_means(self, frame: np.ndarray) -> np.ndarray:
+        # Plain mean of every raw box region, no morphology. Cheap enough for every frame
+        channels = frame.shape[2] if frame.ndim == 3 else 1
+        return np.array(
+            [
+                sum(cv.mean(frame[box.region])[:channels]) / channels
+                for box in self.boxes
+            ]
+        )
+
+    def process_regions(self, regions: list[np.ndarray]) -> np.ndarray:
+        # Same result as process(), for box regions that were cut out earlier
+        intensities = []
+        for region in regions:
+            dilated = cv.dilate(region, self.kernel, iterations=self.dil_it)
+            processed = cv.erode(dilated, self.kernel, iterations=self.er_it)
+            intensities.append(np.mean(processed))
+        return np.array(intensities)
+
+    def _process_per_box(self, frame: np.ndarray) -> np.ndarray:
+        self.processed_regions = []
+        intensities = []
+        for box in self.boxes:
+            dilated = cv.dilate(frame[box.region], self.kernel, iterations=self.dil_it)
+            processed = cv.erode(dilated, self.kernel, iterations=self.er_it)
+            self.processed_regions.append(processed)
+            intensities.append(np.mean(processed))
+        self.intensities = np.array(intensities)
+        return self.intensities
+
+
+class BladePassTracker:
+    """
+    Alpha-beta filter over blade-pass tick times. Predicts the frame of the next pass
+    and the window around it where the detection should look. Locks on after a few
+    ticks that land inside the predicted window, and unlocks again as soon as a
+    predicted pass goes by without a tick.
+
+    Args:
+        alpha (float): how much of a tick's timing error corrects the predicted time.
+        beta (float): how much of a tick's timing error corrects the period.
+        window_fraction (float): half-width of the pass window, as a fraction of the period.
+        min_window (int): smallest half-width of the pass window, in frames.
+        lock_after (int): ticks in a row inside the window before the tracker is locked.
+
+    """
+
+    def __init__(
+        self,
+        alpha: float = 0.5,
+        beta: float = 0.1,
+        window_fraction: float = 0.2,
+        min_window: int = 3,
+        lock_after: int = 3,
+    ):
+        self.alpha = alpha
+        self.beta = beta
+        self.window_fraction = window_fraction
+        self.min_window = min_window
+        self.lock_after = lock_after
+
+        self.last_tick = None
+        self.period = None
+        self.next_tick = None
+        self.consecutive = 0
+        self.misses = 0
+
+    def is_locked(self) -> bool:
+        return self.consecutive >= self.lock_after
+
+    def half_window(self) -> float:
+        return max(self.min_window, self.window_fraction * self.period)
+
+    def in_window(self, frame_cnt: int, lead: int = 0, hold: int = 0) -> bool:
+        # lead opens the window early, hold keeps it open for a while after a tick
+        return (
+            -self.half_window() - lead
+            <= frame_cnt - self.next_tick
+            <= self.half_window()
+        ) or frame_cnt - self.last_tick <= hold
+
+    def observe(self, tick: int) -> None:
+        if self.last_tick is None:
+            self.last_tick = tick
+            return
+
+        if self.period is not None and self.in_window(tick):
+            # Alpha-beta update: correct the prediction and the period by the timing error
+            residual = tick - self.next_tick
+            self.period += self.beta * residual
+            self.next_tick += self.alpha * residual + self.period
+            self.consecutive += 1
+        else:
+            # No usable prediction (yet), start over from the last two ticks
+            self.period = tick - self.last_tick
+            self.next_tick = tick + self.period
+            self.consecutive = 0
+        self.last_tick = tick
+
+    def check_miss(self, frame_cnt: int) -> bool:
+        # A locked tracker whose window passed without a tick has lost the turbine
+        if not self.is_locked() or frame_cnt <= self.next_tick + self.half_window():
+            return False
+        self.misses += 1
+        self.consecutive = 0
+        self.next_tick += self.period
+        return True
+
+    def lockout(self) -> int:
+        # No second tick from the same blade: wait for at least half a period
+        return int(self.period / 2)
 
 
 class BpmCascade(feed.RpmFromFeed):
@@ -132,6 +399,11 @@ class BpmCascade(feed.RpmFromFeed):
     """
 
     def __init__(self, **kwargs):
+        # The feed may already read a frame while it's being set up
+        self.scale = 1.0
+        self.scaled_size = None
+        self.read_done_at = None
+        self.frame_costs = deque()
         super().__init__(**kwargs)
         for key, value in kwargs.items():
             setattr(self, key, value)
@@ -146,6 +418,58 @@ class BpmCascade(feed.RpmFromFeed):
         self.quadrant: int
         self.all_fb_delta_average = 0
         self.frame_buffer_size: int
+        self.store_subregions = kwargs.get("store_subregions", False)
+        self.coarse_gate_fraction = kwargs.get("coarse_gate_fraction", 0)
+        self.coarse_gate_hold = kwargs.get("coarse_gate_hold", self.frame_buffer_size)
+        self.coarse_fb = None
+        self.gate_open_until = self.coarse_gate_hold
+        self.predictive_gating = kwargs.get("predictive_gating", False)
+        self.tracker = BladePassTracker(
+            window_fraction=kwargs.get("predictive_window", 0.2),
+            min_window=kwargs.get("predictive_min_window", 3),
+            lock_after=kwargs.get("predictive_lock_after", 3),
+        )
+        self.predictive_lead = kwargs.get("predictive_lead", self.frame_buffer_size)
+        self.predictive_hold = kwargs.get("predictive_hold", 2 * self.frame_buffer_size)
+        self.detection_lockout = kwargs.get("detection_lockout", 10)
+        self.subframe_ticks = kwargs.get("subframe_ticks", False)
+        self.delta_history = deque(maxlen=3)
+        self.pending_peak = None
+        self.frames_skipped = 0
+        self.frames_backfilled = 0
+        self.frames_measured = 0
+        self.skipped_regions = deque(maxlen=2 * self.frame_buffer_size)
+        self.skipped_samples = 0
+        # Exact detection samples of the backfilled frames, by frame number
+        self.backfilled = {}
+        # Intensities of the skipped frames by frame number, for the spectral series
+        self.skipped_intensities = {}
+        self.rpm_estimator = kwargs.get("rpm_estimator", "ticks")
+        self.spectral = None
+
+        # The spectral estimator needs evenly spaced samples, decimation is for ticks only
+        if self.rpm_estimator != "ticks":
+            self.adaptive_decimation = False
+        self.spectral_window = kwargs.get("spectral_window", 20)
+        self.spectral_update_interval = kwargs.get(
+            "spectral_update_interval", max(int(self.fps), 1)
+        )
+        self.spectral_welch_segments = kwargs.get("spectral_welch_segments", 1)
+        self.spectral_min_rpm = kwargs.get("spectral_min_rpm", 1)
+
+        # Resolution scaling, see update_resolution_scale
+        self.resolution_scaling = kwargs.get("resolution_scaling", False)
+        self.resolution_scales = sorted(
+            set([1.0] + kwargs.get("resolution_scales", [0.75, 0.5])), reverse=True
+        )
+        self.resolution_budget = kwargs.get("resolution_budget", 0.8)
+        self.frame_costs = deque(
+            maxlen=kwargs.get("resolution_check_interval", max(int(self.fps) * 2, 1))
+        )
+        self.full_size = (self.h, self.w)
+        self.fitted_box_params = None
+        self.rescales = 0
+        self.detection_resumes_at = 0
         self.stack_boxes_vertically: bool
         self.stack_boxes_horizontally: bool
         self.trim_last_n_boxes: int
@@ -182,15 +506,157 @@ class BpmCascade(feed.RpmFromFeed):
         corner_pixel = all_corners[list_index]
         return corner_pixel
 
-    def calculate_rpm(self, frame_time: int, fps: float) -> float:
-        return crpm.calculate_rpm_from_frame_time(frame_time, fps)
+    def get_frame(self) -> np.ndarray:
+        # Everything between two reads is what processing a frame costs
+        if self.read_done_at is not None:
+            self.frame_costs.append(time.perf_counter() - self.read_done_at)
+
+        return super().get_frame()
+
+    def count_frame(self, *args, **kwargs) -> None:
+        super().count_frame(*args, **kwargs)
+        self.read_done_at = time.perf_counter()
+
+    def prepare_frame(self, frame: np.ndarray | None) -> np.ndarray | None:
+        frame = super().prepare_frame(frame)
+        if self.scaled_size is not None and frame is not None:
+            frame = cv.resize(frame, self.scaled_size, interpolation=cv.INTER_AREA)
+        return frame
+
+    def update_resolution_scale(self) -> bool:
+        """
+        Steps through resolution_scales so processing a frame fits in
+        resolution_budget of the frame period. Decides once every full window of frame
+        costs: a step down when the median cost is over budget, a step up when the cost
+        predicted for the larger scale is still within it. The morphology cost goes with
+        the pixel count, which overestimates the cost of everything else, so a step up
+        is never undone right away.
+
+        Returns:
+            bool: True if the scale changed, the boxes and the engine are then new.
+
+        """
+        if (
+            not self.resolution_scaling
+            or len(self.frame_costs) < self.frame_costs.maxlen
+        ):
+            return False
+
+        cost = float(np.median(self.frame_costs))
+        budget = self.resolution_budget / self.fps
+        index = self.resolution_scales.index(self.scale)
+        if cost > budget and index < len(self.resolution_scales) - 1:
+            index += 1
+        elif (
+            index > 0
+            and cost * (self.resolution_scales[index - 1] / self.scale) ** 2 < budget
+        ):
+            index -= 1
+        else:
+            self.frame_costs.clear()
+            return False
+
+        print(
+            f"Frame {self.frame_cnt}: resolution scale {self.scale} -> "
+            f"{self.resolution_scales[index]} (frame cost {round(cost * 1000, 2)} ms, "
+            f"budget {round(budget * 1000, 2)} ms)"
+        )
+        self.set_resolution_scale(self.resolution_scales[index])
+        return True
+
+    def set_resolution_scale(self, scale: float) -> None:
+        """
+        Rebuilds the crop geometry, the boxes and the engine for frames downscaled by
+        scale. Box size and kernel follow the scale, the number of boxes stays what was
+        fitted at full resolution. The morphology changes with the scale and so do the box
+        intensities, so the frame buffers and the spectral history start over, and no
+        blade pass is detected until the frame buffer is full again.
+
+        Args:
+            scale (float): fraction of the full crop size to process at.
+
+        """
+        full_h, full_w = self.full_size
+        self.scale = scale
+        self.h, self.w = max(round(full_h * scale), 1), max(round(full_w * scale), 1)
+        self.scaled_size = None if scale == 1 else (self.w, self.h)
+        self._set_config_parameters(self.crop_points)
+        self.center_of_frame = self.get_center_pixel()
+        self.corner = self._get_quadrant_corner_pixel()
+        self.hypotenuse_length = self._get_hypotenuse_length()
+        self.quadrant_subsection = self._get_quadrant_subsection_slice()
+
+        # New boxes come with a new, empty frame buffer
+        num_boxes, box_size = self.fitted_box_params
+        bounds = self.cascade_bounding_boxes(num_boxes, max(int(box_size * scale), 1))
+        self.coarse_fb = None
+        if self.spectral is not None:
+            self.spectral.reset()
+        self.detection_resumes_at = self.frame_cnt + self.frame_buffer_size
+
+        # Cut out at the old size, they can't be redone
+        self.skipped_regions.clear()
+        self.skipped_intensities.clear()
+
+        kernel_size, dil_it, er_it = self.get_dilation_erosion_params()
+        kernel_size = tuple(max(round(k * scale), 1) for k in kernel_size)
+        self.create_cascade_engine(bounds, kernel_size, dil_it, er_it)
+        self.frame_costs.clear()
+        self.rescales += 1
+
+    def update_decimation_from_rpm(
+        self, rpm_buffer: utils.RollingStatistics, frame_ticks: deque
+    ) -> None:
+        # Only trust a full buffer of estimates
+        rpm, spread = 0.0, math.inf
+        if rpm_buffer.full and rpm_buffer.mean > 0:
+            rpm = rpm_buffer.mean
+            spread = rpm_buffer.std() / rpm
+
+            # An overdue blade pass means the estimate is out of date
+            expected_period = 60 * self.fps / (3 * rpm)
+            if frame_ticks and self.frame_cnt - frame_ticks[-1] > 2 * expected_period:
+                spread = math.inf
+        self.update_decimation(rpm, spread)
+
+    def calculate_rpm(self, tick_interval: float) -> float:
+        return crpm.calculate_rpm_from_tick_interval(tick_interval)
 
     def update_global_fb_average(self):
-        self.rank_and_weight_bounding_boxes()
-        sum = []
-        for box in self.bounds.values():
-            sum.append(box.fb.average_delta)
-        self.all_fb_delta_average = np.mean(sum)
+        weighted = self.rank_and_weight_bounding_boxes()
+        self.all_fb_delta_average = np.mean(weighted)
+        self.delta_history.append((self.frame_cnt, self.all_fb_delta_average))
+
+    def refine_peak_tick(self) -> float | None:
+        # A detection fires when the delta crosses the threshold, somewhere on the way up.
+        # Once the delta starts dropping again, a parabola through the last three samples
+        # puts the tick at the peak, with sub-frame precision. The samples are fitted at
+        # their own frames, a stride change leaves them unevenly spaced
+        if self.pending_peak is None or len(self.delta_history) < 3:
+            return None
+
+        (t_left, left), (t_peak, centre), (t_right, right) = self.delta_history
+        if t_right == self.frame_cnt and t_peak >= self.pending_peak and right < centre:
+            before, after = t_peak - t_left, t_right - t_peak
+            rise, fall = centre - left, centre - right
+            # Positive when the parabola opens downwards
+            spread = before * fall + after * rise
+            offset = (
+                0.5 * (before**2 * fall - after**2 * rise) / spread
+                if spread > 0
+                else 0.0
+            )
+            self.pending_peak = None
+            return t_peak - offset
+
+        # No peak in sight, fall back to the detection frame
+        if (
+            self.frame_cnt - self.pending_peak
+            > 4 * self.color_delta_update_frequency * self.stride
+        ):
+            tick, self.pending_peak = self.pending_peak, None
+            return float(tick)
+        return None
 
     def print_useful_stats(
         self,
@@ -199,6 +665,7 @@ class BpmCascade(feed.RpmFromFeed):
         detection_enable_toggle: bool = True,
         threshold: float = 0,
         mode: float = 0,
+        spectral_rpm: float | None = None,
     ) -> None:
         # Frame counter
         print(
@@ -224,6 +691,10 @@ class BpmCascade(feed.RpmFromFeed):
             end="",
         )
 
+        # Spectral estimate, when it runs alongside the ticks
+        if spectral_rpm is not None:
+            print(f"Spectral RPM: {round(spectral_rpm, 3)} - ", end="")
+
         # Time since last detection
         print(
             f"Last detection {self.frame_cnt - (0 if not frame_ticks else frame_ticks[-1])} frames ago - ",
@@ -260,8 +731,19 @@ class BpmCascade(feed.RpmFromFeed):
     def update_detection_enable_toggle(
         self, intensity_delta, threshold, mode, frame_ticks
     ):
+        # A locked tracker knows how long until the next blade can come by
+        if self.predictive_gating and self.tracker.is_locked():
+            lockout = self.tracker.lockout()
+        else:
+            lockout = self.detection_lockout
+
+        # A detection that is still waiting for its peak counts as the last tick
+        last_tick = max(
+            0 if not frame_ticks else frame_ticks[-1],
+            0 if self.pending_peak is None else self.pending_peak,
+        )
         if (mode - threshold < intensity_delta < mode + threshold) and (
-            self.frame_cnt - (0 if not frame_ticks else frame_ticks[-1]) > 10
+            self.frame_cnt - last_tick > lockout
         ):
             self.detection_enable_toggle = True
 
@@ -271,29 +753,121 @@ class BpmCascade(feed.RpmFromFeed):
         if (
             self.all_fb_delta_average > (mode + self.threshold_multiplier * deviation)
             and self.detection_enable_toggle
+            and self.frame_cnt >= self.detection_resumes_at
         ):
             return True
         else:
             return False
 
-    def rank_and_weight_bounding_boxes(self):
+    def rank_and_weight_bounding_boxes(self) -> np.ndarray:
         # Get all detection strengths
-        buffer_values = {}
-        for box in self.bounds.values():
-            buffer_values[f"{box.id}"] = box.fb.average_delta
+        weighted, self.box_ranks = self._weight_by_rank(self.fb.average_delta)
+        return weighted
 
-        # Sort boxes based on detection strength
-        self.sorted_ids_by_strength = sorted(
-            buffer_values, key=buffer_values.__getitem__, reverse=True
-        )
+    @staticmethod
+    def _weight_by_rank(average_deltas: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # Sort boxes based on detection strength. Stable, so ties keep cascade order
+        order = np.argsort(-average_deltas, kind="stable")
+        ranks = np.empty_like(order)
+        ranks[order] = np.arange(len(order))
 
         # Apply ranking based on detection strength
-        weights = np.linspace(1, 0, len(self.sorted_ids_by_strength))
-        for rank, id in enumerate(self.sorted_ids_by_strength):
-            self.bounds[id].rank = rank
-            self.bounds[id].fb.average_delta = (
-                self.bounds[id].fb.average_delta * weights[rank]
-            )  # Rank is also just an index
+        weights = np.linspace(1, 0, len(order))
+        return (average_deltas * weights[ranks], ranks)  # Rank is also just an index
+
+    def gating_enabled(self) -> bool:
+        return self.coarse_gate_fraction > 0 or self.predictive_gating
+
+    def frame_needs_processing(self, frame: np.ndarray, threshold: float) -> bool:
+        is_open = True
+        if self.coarse_gate_fraction > 0:
+            is_open = self._coarse_gate_is_open(frame, threshold)
+
+        # Only look where the next blade pass is expected. A missed pass unlocks
+        # the tracker, which brings back the full scan
+        if self.predictive_gating and self.tracker.is_locked():
+            self.tracker.check_miss(self.frame_cnt)
+            if self.tracker.is_locked() and not self.tracker.in_window(
+                self.frame_cnt, self.predictive_lead, self.predictive_hold
+            ):
+                is_open = False
+
+        # Skipped frames go into the frame buffer as unchanged boxes. Their raw regions
+        # are kept so the buffer can be corrected once the gate opens again
+        if not is_open:
+            self.frames_skipped += 1
+            self.skipped_regions.append(
+                (
+                    self.frame_cnt,
+                    [frame[box.region].copy() for box in self.engine.boxes],
+                )
+            )
+            self.fb.insert(self.engine.intensities, processed=False)
+            # One in frame_buffer_size samples of the detection statistics while the gate
+            # is closed is measured, so they still see what the quiet frames look like
+            if self.frames_read % self.color_delta_update_frequency == 0:
+                if self.skipped_samples % self.frame_buffer_size == 0:
+                    self._measure_skipped_frame()
+                self.skipped_samples += 1
+            self.fb.update_color_delta_average()
+            if self.spectral is not None:
+                newest, _ = self.fb.delta_rows()
+                self.skipped_intensities[self.frame_cnt] = self.fb.intensities[
+                    newest
+                ].copy()
+            return False
+
+        # Morphology reacts to a blade a few frames before the raw means do, so redo
+        # the last skipped frames. Their deltas are exact once they're taken against
+        # processed rows, those go into backfilled for the detection statistics
+        self.skipped_samples = 0
+        if self.skipped_regions:
+            self.backfilled.clear()
+            self.fb.rewind(len(self.skipped_regions))
+            for frame_cnt, regions in self.skipped_regions:
+                row = self.fb.count % self.fb.rows
+                if self.fb.processed[row]:
+                    intensities = self.fb.intensities[row].copy()
+                else:
+                    intensities = self.engine.process_regions(regions)
+                    self.frames_backfilled += 1
+                self.fb.insert(intensities, frame=frame_cnt)
+                self.fb.update_color_delta_average()
+                if self.fb.delta_is_exact():
+                    weighted, _ = self._weight_by_rank(self.fb.average_delta)
+                    self.backfilled[frame_cnt] = float(np.mean(weighted))
+                if frame_cnt in self.skipped_intensities:
+                    self.skipped_intensities[frame_cnt] = intensities
+            self.skipped_regions.clear()
+        return True
+
+    def _measure_skipped_frame(self) -> None:
+        # A delta only depends on the newest row and the row it's taken against, so
+        # processing those two gives the frame's exact delta
+        regions = dict(self.skipped_regions)
+        newest, oldest = self.fb.delta_rows()
+        for row in (oldest, newest):
+            frame_cnt = self.fb.frames[row]
+            if not self.fb.processed[row] and frame_cnt in regions:
+                self.fb.intensities[row] = self.engine.process_regions(
+                    regions[frame_cnt]
+                )
+                self.fb.processed[row] = True
+                self.frames_measured += 1
+
+    def _coarse_gate_is_open(self, frame: np.ndarray, threshold: float) -> bool:
+        # The same delta average as the real detection, but on raw box means.
+        # The full processing only runs while this gets close to the threshold,
+        # and for coarse_gate_hold frames after
+        if self.coarse_fb is None:
+            self.coarse_fb = FrameBuffer(self, self.frame_buffer_size, len(self.bounds))
+        self.coarse_fb.insert(self.engine.box_means(frame))
+        self.coarse_fb.update_color_delta_average()
+        weighted, _ = self._weight_by_rank(self.coarse_fb.average_delta)
+
+        if np.mean(weighted) > self.coarse_gate_fraction * threshold:
+            self.gate_open_until = self.frame_cnt + self.coarse_gate_hold
+        return self.frame_cnt <= self.gate_open_until
 
     def boxes_in_radius(self, box_size: int) -> int:
         # In the horizontal or vertical stacking cases,
@@ -320,12 +894,38 @@ class BpmCascade(feed.RpmFromFeed):
         self.resize_boxes: bool
         self.adjust_num_boxes: bool
 
-        return self.fit_box_parameters_to_radius(
+        # Kept for rescaling, see set_resolution_scale
+        self.fitted_box_params = self.fit_box_parameters_to_radius(
             self.target_num_boxes,
             self.target_box_size,
             self.resize_boxes,
             self.adjust_num_boxes,
         )
+        return self.fitted_box_params
+
+    def create_cascade_engine(
+        self,
+        bounds: dict[str, BoundingBox],
+        kernel_size: tuple[int, int],
+        dil_it: int,
+        er_it: int,
+    ) -> CascadeEngine:
+        self.engine = CascadeEngine(
+            bounds, (self.h, self.w), kernel_size, dil_it, er_it
+        )
+        return self.engine
+
+    def create_spectral_estimator(self) -> SpectralRpmEstimator:
+        # Needs the boxes and the rpm bounds, call after cascading and process_rpm_bounds
+        self.spectral = SpectralRpmEstimator(
+            int(self.spectral_window * self.fps),
+            len(self.bounds),
+            self.fps,
+            min_rpm=self.spectral_min_rpm,
+            max_rpm=self.max_rpm,
+            segments=self.spectral_welch_segments,
+        )
+        return self.spectral
 
     def get_dilation_erosion_params(self):
         self.erosion_dilation_kernel_size: list[int]
@@ -449,8 +1049,16 @@ class BpmCascade(feed.RpmFromFeed):
             box_y = round(offset_y + delta_y * i)
             box_center = (box_x, box_y)
 
-            bounds[f"{i}"] = BoundingBox.from_center_and_size(
-                box_center, box_size, self.frame_buffer_size, i
-            )
+            bounds[f"{i}"] = BoundingBox.from_center_and_size(box_center, box_size, i)
         self.bounds = bounds
+
+        # One frame buffer for all boxes, one column per box
+        # With gating, skipped frames are redone from up to 2 buffers back
+        self.fb = FrameBuffer(
+            self,
+            self.frame_buffer_size,
+            len(bounds),
+            self.store_subregions,
+            history=2 * self.frame_buffer_size if self.gating_enabled() else 0,
+        )
         return bounds
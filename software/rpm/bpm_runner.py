@@ -0,0 +1,338 @@
+import bisect
+import math
+import time
+from collections import deque
+from datetime import datetime, timedelta
+import numpy as np
+from . import utils
+from .feed.capture import CropView
+
+
+class BpmRunner:
+    """
+    Runs blade-pass detection on the frames of one BpmCascade: box processing,
+    detection statistics, ticks, RPM and the output rows. main.py drives one of these
+    for a single turbine, multi-turbine mode one per turbine.
+
+    Args:
+        feed (BpmCascade): the feed the frames come from.
+        params (dict from JSON-config file): see software/config/config_template.json.
+        deploy (bool): write rows to output_file instead of drawing and printing stats.
+        output_file (file): where rows are written in deploy mode.
+
+    """
+
+    def __init__(self, feed, params: dict, deploy: bool = False, output_file=None):
+        self.feed = feed
+        self.deploy = deploy
+        self.output_file = output_file
+
+        # Region and processing setup
+        box_params = feed.get_fitted_box_params_from_cfg()
+        bounds = feed.cascade_bounding_boxes(*box_params)
+        kernel_er_dil_params = feed.get_dilation_erosion_params()
+        feed.create_cascade_engine(bounds, *kernel_er_dil_params)
+
+        # Filtering setup
+        # deque for ease of use, we only need the last 2 ticks to measure tick time
+        self.frame_ticks = deque(maxlen=2)
+        self.tick_times = deque(maxlen=2)
+        self.clock_changes = feed.clock_changes
+        self.fb_average_long_buffer = utils.RollingStatistics(
+            maxlen=int(params["fps"] * 60)
+        )
+        self.rpm_buffer = utils.RollingStatistics(
+            maxlen=params["rpm_buffer_length"], track_mode=False
+        )
+        self.deviation, self.mode = 0, 0
+        self.prev_rpm, self.rpm = 0, 0
+        # The samples of skipped frames wait for the gate to open, with their delta if
+        # it's exact. The others take the nearest exact one
+        self.pending_samples = []
+        self.spectral_due = False
+        # The RPM of every row written, for run summaries
+        self.logged_rpms = []
+        feed.process_rpm_bounds()
+
+        # The spectral estimator runs on the same box intensities as the ticks,
+        # either alongside them or instead of them
+        self.spectral = None
+        self.spectral_rpm = None
+        if feed.rpm_estimator in ("spectral", "both"):
+            self.spectral = feed.create_spectral_estimator()
+
+    def process(self, frame: np.ndarray) -> np.ndarray | None:
+        """
+        Runs detection on one frame and writes a row if the RPM changed.
+
+        Args:
+            frame (np.ndarray): the frame the feed just returned.
+
+        Returns:
+            np.ndarray | None: the frame with the processing drawn on, None in deploy mode.
+
+        """
+        feed = self.feed
+
+        # With gating, frames where no blade pass is expected skip processing
+        # and count as unchanged boxes
+        processed = not feed.gating_enabled() or feed.frame_needs_processing(
+            frame, self.mode + feed.threshold_multiplier * self.deviation
+        )
+        if processed:
+            # To start, all boxes are processed in one pass
+            feed.engine.process(frame)
+
+        # Detection may rescale the boxes, draw the ones this frame was processed with
+        bounds = feed.bounds
+        self.detect(feed.engine.intensities, feed.engine.processed_regions, processed)
+
+        row = self.report()
+        if row is not None:
+            self.output_file.write(row)
+        if self.deploy:
+            return None
+        return self.draw(
+            frame, bounds, feed.engine.processed_regions if processed else None
+        )
+
+    def detect(
+        self,
+        intensities: np.ndarray,
+        processed_regions: list[np.ndarray],
+        processed: bool = True,
+    ) -> None:
+        """
+        Everything after the box processing: frame buffer, detection statistics,
+        ticks and RPM.
+
+        Args:
+            intensities (np.ndarray): box intensities of the frame.
+            processed_regions (list): the processed box regions.
+            processed (bool): False if gating skipped the frame, it's already in the buffer.
+
+        """
+        feed = self.feed
+
+        # Saved in the frame buffer, one column per box
+        if processed:
+            feed.fb.insert(intensities, processed_regions)
+            feed.fb.update_color_delta_average()
+
+        # Update decection values. The stale deltas of a skipped frame don't go into
+        # the statistics, its sample waits for the gate to open
+        if processed and self.pending_samples:
+            self.take_pending_samples()
+        if feed.frames_read % feed.color_delta_update_frequency == 0:
+            feed.update_global_fb_average()
+            if processed:
+                self.fb_average_long_buffer.append(feed.all_fb_delta_average)
+                self.mode = self.fb_average_long_buffer.mode()
+                self.deviation = self.fb_average_long_buffer.std()
+            else:
+                exact = feed.fb.delta_is_exact()
+                self.pending_samples.append(
+                    (feed.frame_cnt, feed.all_fb_delta_average if exact else None)
+                )
+
+        if self.spectral is not None:
+            if feed.frame_cnt % feed.spectral_update_interval == 0:
+                self.spectral_due = True
+            # Skipped frames go in once the gate opens, as far as possible backfilled
+            if processed:
+                for skipped in feed.skipped_intensities.values():
+                    self.spectral.insert(skipped)
+                feed.skipped_intensities.clear()
+                self.spectral.insert(intensities)
+            if processed and self.spectral_due:
+                self.spectral_due = False
+                estimate = self.spectral.estimate()
+                if estimate is not None:
+                    self.spectral_rpm = estimate
+                    if feed.rpm_estimator == "spectral" and (
+                        self.spectral_rpm < feed.max_rpm
+                    ):
+                        self.rpm = self.spectral_rpm
+                        self.rpm_buffer.append(self.rpm)
+
+        # Check if the new values indicate a detection
+        tick = None
+        if feed.rpm_estimator != "spectral" and (
+            feed.blade_detection_in_box_regions(float(self.deviation), float(self.mode))
+        ):
+            # Note the frame we detect the blade. With sub-frame ticks, the tick
+            # is placed at the peak of the delta once it has passed
+            if feed.subframe_ticks:
+                feed.pending_peak = feed.frame_cnt
+            else:
+                tick = feed.frame_cnt
+            feed.tracker.observe(feed.frame_cnt)
+
+            # Stop additional triggers until we've stabilized
+            feed.detection_enable_toggle = False
+
+        if feed.subframe_ticks:
+            tick = feed.refine_peak_tick()
+
+        # A tick time from before the feed changed clocks can't be compared with new ones
+        if feed.clock_changes != self.clock_changes:
+            self.clock_changes = feed.clock_changes
+            self.tick_times.clear()
+
+        if tick is not None:
+            self.frame_ticks.append(tick)
+            self.tick_times.append(feed.timestamp_at(tick))
+
+            # We cant do calculations with one detection
+            if len(self.tick_times) == 2:
+                self.rpm = feed.calculate_rpm(self.tick_times[1] - self.tick_times[0])
+
+                # Ignore detections if they are unreasonable.
+                # The tick has been stored but the output is not updated
+                if self.rpm_buffer:
+
+                    # Turbines wont spin faster than 35RPM. they will not "brake"
+                    # faster than a loss of 3 RPM per third of a rotation.
+                    # Detections saying otherwise are assumed false.
+                    if feed.rpm_within_bounds(self.rpm, self.prev_rpm):
+                        self.rpm_buffer.append(self.rpm)
+
+                # The first detection we append anyway
+                else:
+                    self.rpm_buffer.append((self.rpm if self.rpm < 30 else 0))
+
+        feed.update_detection_enable_toggle(
+            feed.all_fb_delta_average, self.deviation, self.mode, self.frame_ticks
+        )
+
+        # Slow, steady turbines don't need every frame
+        if feed.adaptive_decimation:
+            feed.update_decimation_from_rpm(self.rpm_buffer, self.frame_ticks)
+
+        # Process at a lower resolution when frames take too long
+        feed.update_resolution_scale()
+
+    def take_pending_samples(self) -> None:
+        """
+        Adds the samples of the frames gating skipped to the detection statistics, in
+        order. Measured and backfilled frames give their exact deltas, the other ones
+        repeat the exact sample nearest to them, or the last sample if there is none.
+
+        """
+        exact = {
+            frame_cnt: sample
+            for frame_cnt, sample in self.pending_samples
+            if sample is not None
+        }
+        exact.update(self.feed.backfilled)
+        frames = sorted(exact)
+        buffer = self.fb_average_long_buffer
+        for frame_cnt, _ in self.pending_samples:
+            if not frames:
+                sample = buffer.values[-1] if buffer else 0
+            else:
+                i = bisect.bisect(frames, frame_cnt)
+                nearest = min(
+                    frames[max(i - 1, 0) : i + 1], key=lambda f: abs(f - frame_cnt)
+                )
+                sample = exact[nearest]
+            buffer.append(sample)
+        self.pending_samples.clear()
+        self.mode = buffer.mode()
+        self.deviation = buffer.std()
+
+    def report(self) -> str | None:
+        """
+        The output row of the current frame in deploy mode, if the RPM changed.
+        Prints the stats otherwise.
+
+        Returns:
+            str | None: the row to write.
+
+        """
+        feed = self.feed
+        row = None
+        threshold = self.mode + feed.threshold_multiplier * self.deviation
+        spectral_rpm = self.spectral_rpm if feed.rpm_estimator == "both" else None
+        if self.deploy:
+            if feed.frame_cnt % 1000 == 0:
+                print("RPM calculation is running...")
+                if feed.drop_late_frames:
+                    print(f"Live feed: {feed.live_stats()}")
+
+            # Only append new values. Timestamp differences carry float noise
+            if not math.isclose(self.rpm, self.prev_rpm, rel_tol=1e-9):
+                # Rows are stamped with the time the frame was captured
+                latency = time.monotonic() - feed.frame_arrival
+                tick_timestamp = datetime.now() - timedelta(seconds=latency)
+                row = utils.dynamic_log_string(
+                    feed,
+                    tick_timestamp,
+                    (feed.all_fb_delta_average, self.mode, threshold),
+                    self.rpm_buffer,
+                    print_error=True,
+                    real_rpm=feed.real_rpm,
+                    spectral_rpm=spectral_rpm,
+                    latency_ms=round(latency * 1000, 3),
+                )
+                self.logged_rpms.append(self.rpm_buffer.mean)
+        else:
+            smoothed_rpm = [round(self.rpm_buffer.mean, 3)]
+            feed.print_useful_stats(
+                out=smoothed_rpm,
+                frame_ticks=self.frame_ticks,
+                detection_enable_toggle=feed.detection_enable_toggle,
+                threshold=threshold,
+                mode=self.mode,
+                spectral_rpm=spectral_rpm,
+            )
+
+        self.prev_rpm = self.rpm
+        return row
+
+    def draw(
+        self,
+        frame: np.ndarray,
+        bounds: dict,
+        processed_regions: list[np.ndarray] | None,
+    ) -> np.ndarray:
+        # Luma-only frames are drawn on a colour copy. Crops of a shared source are
+        # views of the frame the other turbines are still reading, so they're copied too
+        display_frame = self.feed.draw.colour_view(frame)
+        if display_frame is frame and isinstance(self.feed.video, CropView):
+            display_frame = frame.copy()
+
+        #  Draw a  border around the bounding box processed region
+        #  do this after inserting the regions into the frame buffer!!!!
+        #  if not we store the regions WITH borders drawn on
+        if processed_regions is not None:
+            for bounding_box, processed_region in zip(
+                bounds.values(), processed_regions
+            ):
+                display_region = self.feed.draw.colour_view(processed_region)
+                bounding_box.draw.border_around_region(display_region, 1, [0, 255, 0])
+                # Draw processing
+                display_frame = bounding_box.draw.processing_results(
+                    display_frame, bounding_box.region, display_region
+                )
+        return display_frame
+
+    def finish(self) -> None:
+        # Summaries of the optional frame-skipping features
+        feed = self.feed
+        if feed.adaptive_decimation:
+            print(
+                f"Decimation grabbed {feed.frames_grabbed_only} of {feed.frame_cnt} "
+                f"frames without decoding them"
+            )
+        if feed.gating_enabled():
+            print(
+                f"Gating skipped {feed.frames_skipped} of {feed.frame_cnt} frames "
+                f"({round(100 * feed.frames_skipped / max(feed.frame_cnt, 1), 1)}%), "
+                f"{feed.frames_backfilled} of them were processed late and "
+                f"{feed.frames_measured} times to sample the detection statistics"
+            )
+        if feed.predictive_gating:
+            print(f"Predicted blade passes missed: {feed.tracker.misses}")
+        if feed.resolution_scaling:
+            print(f"Resolution scale {feed.scale} after {feed.rescales} rescales")
@@ -79,17 +79,105 @@ def get_rpm_from_flow_vectors(
         fps (float): FPS of the video feed
     """
 
-    magnitudes = []
-    for vector in velocity_vectors:
-        mag = math.sqrt(vector[0] ** 2 + vector[1] ** 2)
-        magnitudes.append(mag)
-    magnitudes = magnitudes
+    velocity_vectors = np.asarray(velocity_vectors, dtype=float).reshape(-1, 2)
+    magnitudes = np.hypot(velocity_vectors[:, 0], velocity_vectors[:, 1])
     vel = np.mean(magnitudes)
 
     rpm = 60 * calculate_frequency(float(vel), radius, fps)
     return rpm
 
 
+def angular_velocities_around_hub(
+    points: np.ndarray,
+    velocity_vectors: np.ndarray,
+    hub_center: tuple[float, float],
+    min_radius: float = 1.0,
+) -> np.ndarray:
+    """
+    Finds the angular velocity of every tracked point around the hub, r x v / |r|^2.
+    Unlike the magnitude method, every point uses its own distance to the hub.
+    Points closer to the hub than min_radius are left out.
+
+    Args:
+        points (np.ndarray): (N, 2) point positions in pixels.
+        velocity_vectors (np.ndarray): (N, 2) motion of the points in pixels per frame.
+        hub_center (tuple): (x, y) position of the hub in the same coordinates as the points.
+        min_radius (float): minimum distance from the hub in pixels.
+
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    velocity_vectors = np.asarray(velocity_vectors, dtype=float).reshape(-1, 2)
+
+    r = points - np.asarray(hub_center, dtype=float)
+    r_squared = np.einsum("ij,ij->i", r, r)
+    cross = r[:, 0] * velocity_vectors[:, 1] - r[:, 1] * velocity_vectors[:, 0]
+
+    valid = r_squared >= min_radius**2
+    return cross[valid] / r_squared[valid]  # Units: rad / frame
+
+
+def robust_mean(values: np.ndarray, n_mads: float = 3.0) -> tuple[float, float]:
+    """
+    Rejects outliers further than n_mads median absolute deviations from the median,
+    then averages the rest. Returns the mean and a confidence in [0, 1], which is the
+    share of inliers scaled down by the relative spread of the inliers.
+
+    Args:
+        values (np.ndarray): values to average.
+        n_mads (float): rejection threshold in (normal-consistent) median absolute deviations.
+
+    """
+    values = np.asarray(values, dtype=float)
+    if values.size == 0:
+        return (np.nan, 0.0)
+
+    median = np.median(values)
+    mad = 1.4826 * np.median(np.abs(values - median))
+    inliers = values[np.abs(values - median) <= n_mads * mad]
+    if inliers.size == 0:
+        inliers = values[values == median]
+    if inliers.size == 0:
+        return (float(median), 0.0)
+
+    mean = float(np.mean(inliers))
+    relative_spread = float(np.std(inliers)) / abs(mean) if mean != 0 else np.inf
+    confidence = (inliers.size / values.size) / (1 + relative_spread)
+    return (mean, confidence)
+
+
+def get_rpm_from_angular_velocities(
+    points: np.ndarray,
+    velocity_vectors: np.ndarray,
+    hub_center: tuple[float, float],
+    fps: float,
+    min_radius: float = 1.0,
+) -> tuple[float | None, float]:
+    """
+    Used in optical flow mode. Estimates RPM from the per-point angular velocity
+    around the hub, with outliers rejected. Returns (rpm, confidence), see robust_mean.
+    The direction of rotation is ignored.
+
+    Args:
+        points (np.ndarray): (N, 2) point positions in pixels.
+        velocity_vectors (np.ndarray): (N, 2) motion of the points in pixels per frame.
+        hub_center (tuple): (x, y) position of the hub.
+        fps (float): FPS of the video feed
+        min_radius (float): points closer to the hub than this are ignored.
+
+    """
+    ang_vels = angular_velocities_around_hub(
+        points, velocity_vectors, hub_center, min_radius
+    )
+    if ang_vels.size == 0:
+        return (None, 0.0)
+
+    ang_vel, confidence = robust_mean(ang_vels)
+
+    # Units: (rad / frame) * (frames / second) = rad/s
+    freq = abs(ang_vel) * fps / (2 * math.pi)
+    return (60 * freq, confidence)
+
+
 def calculate_rpm_from_frame_time(frame_time: int, fps: float) -> float:
     """
     Used in bpm cascade mode. Calculates BPM based on the time between blade detections.
@@ -100,12 +188,36 @@ def calculate_rpm_from_frame_time(frame_time: int, fps: float) -> float:
     """
 
     real_time = frame_time / fps
+    return calculate_rpm_from_tick_interval(real_time)
+
+
+def calculate_rpm_from_tick_interval(tick_interval: float) -> float:
+    """
+    Used in bpm cascade mode. Calculates BPM based on the time between blade detections.
+
+    Args:
+        tick_interval (float): time between blade detections given in seconds
+    """
+
     # Any of the 3 blades can trigger a tick, luckily they
     # are evenly spaced 120 degrees apart
-    adjusted_ticktime_seconds = real_time * 3
+    adjusted_ticktime_seconds = tick_interval * 3
     return 60 / adjusted_ticktime_seconds
 
 
+def rpm_from_blade_pass_frequency(frequency: float, num_blades: int = 3) -> float:
+    """
+    Used in bpm cascade mode. Converts the rate at which blades pass a point (in Hz)
+    to rotor RPM. The inverse of calculate_rpm_from_frame_time.
+
+    Args:
+        frequency (float): blade passes per second
+        num_blades (int): number of blades on the rotor
+    """
+
+    return 60 * frequency / num_blades
+
+
 if __name__ == "__main__":
     rpms = []
     errors = []
@@ -0,0 +1,389 @@
+import functools
+import re
+import shutil
+import subprocess
+import time
+import cv2 as cv
+import numpy as np
+from .prefetch import FramePrefetcher
+from .frame_bus import FrameBusReader
+
+
+@functools.lru_cache(maxsize=None)
+def _ffmpeg_version() -> tuple[int, int] | None:
+    # (major, minor) of the ffmpeg on the PATH, None for builds from git and the like
+    result = subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True)
+    match = re.match(r"ffmpeg version n?(\d+)\.(\d+)", result.stdout)
+    if match is None:
+        return None
+    return (int(match.group(1)), int(match.group(2)))
+
+
+def _passthrough_timing_args() -> list[str]:
+    # -fps_mode replaced -vsync in ffmpeg 5.1, older versions only know -vsync
+    version = _ffmpeg_version()
+    if version is not None and version < (5, 1):
+        return ["-vsync", "passthrough"]
+    return ["-fps_mode", "passthrough"]
+
+
+class FfmpegCropCapture:
+    """
+    Reads a saved video through an ffmpeg pipe with a crop filter applied, so only
+    the region of interest is converted and copied into Python. Mimics the parts of
+    cv.VideoCapture that the feeds use.
+
+    Args:
+        target (str): path to the video file.
+        crop_points (list): [[y1,y2],[x1,x2]] in full-frame pixel coordinates.
+        fps (float): fps of the video, used for position bookkeeping.
+        grayscale (bool): have ffmpeg deliver single-channel luma frames instead of BGR.
+
+    """
+
+    def __init__(
+        self, target: str, crop_points: list, fps: float, grayscale: bool = False
+    ):
+        (y1, y2), (x1, x2) = crop_points
+        self.h = y2 - y1
+        self.w = x2 - x1
+        self.fps = fps
+        self.frame_idx = 0
+        self.shape = (self.h, self.w) if grayscale else (self.h, self.w, 3)
+        self._grabbed = np.empty(self.shape, dtype=np.uint8)
+
+        cmd = [
+            "ffmpeg",
+            "-v",
+            "error",
+            "-nostdin",
+            "-i",
+            target,
+            "-vf",
+            f"crop={self.w}:{self.h}:{x1}:{y1}",
+            *_passthrough_timing_args(),
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "gray" if grayscale else "bgr24",
+            "-",
+        ]
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=0)
+
+    def _read_into(self, image: np.ndarray) -> bool:
+        view = memoryview(image.reshape(-1))
+        filled = 0
+        while filled < len(view):
+            n = self.proc.stdout.readinto(view[filled:])
+            if not n:
+                return False
+            filled += n
+        self.frame_idx += 1
+        return True
+
+    def isOpened(self) -> bool:
+        return self.proc.poll() is None or self.proc.returncode == 0
+
+    def read(self, image: np.ndarray | None = None) -> tuple[bool, np.ndarray | None]:
+        if image is None or image.shape != self.shape or not image.flags.c_contiguous:
+            image = np.empty(self.shape, dtype=np.uint8)
+        if not self._read_into(image):
+            return (False, None)
+        return (True, image)
+
+    def grab(self) -> bool:
+        return self._read_into(self._grabbed)
+
+    def retrieve(self, image: np.ndarray | None = None) -> tuple[bool, np.ndarray]:
+        if image is None or image.shape != self.shape:
+            return (True, self._grabbed.copy())
+        image[...] = self._grabbed
+        return (True, image)
+
+    def get(self, prop: int) -> float:
+        if prop == cv.CAP_PROP_FRAME_WIDTH:
+            return float(self.w)
+        if prop == cv.CAP_PROP_FRAME_HEIGHT:
+            return float(self.h)
+        if prop == cv.CAP_PROP_FPS:
+            return float(self.fps)
+        if prop == cv.CAP_PROP_POS_FRAMES:
+            return float(self.frame_idx)
+        if prop == cv.CAP_PROP_POS_MSEC:
+            # Timestamp of the last returned frame, like OpenCV does
+            return max(self.frame_idx - 1, 0) * 1000 / self.fps
+        return 0.0
+
+    def set(self, prop: int, value: float) -> bool:
+        return False
+
+    def release(self) -> None:
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.stdout.close()
+        self.proc.wait()
+
+
+class SharedFrameSource:
+    """
+    Decodes a video source once for several feeds. advance() reads the next full frame,
+    and every feed reads its crop of that frame through its own CropView.
+
+    Args:
+        target (str or int): path to the video file or the camera.
+        fps (float): fps of the video feed.
+        prefetch_depth (int): if above 0, decode on a background thread, see FramePrefetcher.
+        prefetch_policy (str): what the prefetch thread does when its ring is full.
+
+    """
+
+    def __init__(
+        self,
+        target,
+        fps: float,
+        prefetch_depth: int = 0,
+        prefetch_policy: str = "block",
+    ):
+        self.fps = fps
+        self.video, _ = open_capture(target, None, fps)
+        if prefetch_depth > 0:
+            self.video = FramePrefetcher(
+                self.video, depth=prefetch_depth, policy=prefetch_policy
+            )
+        self.ret = False
+        self.frame = None
+        self.frame_idx = 0
+        self.last_arrival = 0.0
+
+    def advance(self) -> bool:
+        # Only call this once every view has read the current frame
+        self.ret, self.frame = self.video.read()
+        if self.ret:
+            self.frame_idx += 1
+            self.last_arrival = (
+                getattr(self.video, "last_arrival", None) or time.monotonic()
+            )
+        return self.ret
+
+    def view(self, crop_points: list) -> "CropView":
+        return CropView(self, crop_points)
+
+    def release(self) -> None:
+        self.video.release()
+
+
+class CropView:
+    """
+    One feed's crop of a SharedFrameSource. Mimics the parts of cv.VideoCapture that
+    the feeds use, read() returns a numpy view into the shared frame, nothing is copied.
+    A view can't skip frames on its own, the source decides when to move on.
+
+    Args:
+        source (SharedFrameSource): the source decoding the frames.
+        crop_points (list): [[y1,y2],[x1,x2]] in full-frame pixel coordinates.
+
+    """
+
+    def __init__(self, source: SharedFrameSource, crop_points: list):
+        (y1, y2), (x1, x2) = crop_points
+        self.source = source
+        self.region = (slice(y1, y2), slice(x1, x2))
+
+    @property
+    def last_arrival(self) -> float:
+        return self.source.last_arrival
+
+    def isOpened(self) -> bool:
+        return self.source.video.isOpened()
+
+    def read(self) -> tuple[bool, np.ndarray | None]:
+        if not self.source.ret:
+            return (False, None)
+        return (True, self.source.frame[self.region])
+
+    def grab(self) -> bool:
+        # Nothing to skip, the source decides when to move on
+        return self.source.ret
+
+    def get(self, prop: int) -> float:
+        return self.source.video.get(prop)
+
+    def set(self, prop: int, value: float) -> bool:
+        return False
+
+    def release(self) -> None:
+        # The source is shared, whoever created it releases it
+        pass
+
+
+def is_camera(target) -> bool:
+    # V4L2 device, as opposed to a saved video, a stream URL or a frame bus
+    return isinstance(target, str) and target.startswith("/dev/video")
+
+
+def _crop_inside_frame(crop_points: list, width: int, height: int) -> bool:
+    (y1, y2), (x1, x2) = crop_points
+    return 0 <= x1 < x2 <= width and 0 <= y1 < y2 <= height
+
+
+def _request_luma(video: cv.VideoCapture) -> None:
+    # Ask the camera for YUYV and skip OpenCV's conversion to BGR, so frames arrive
+    # as (h, w, 2) with the Y plane in channel 0. Other formats are left alone,
+    # the feed converts those after cropping.
+    yuyv = cv.VideoWriter_fourcc(*"YUYV")
+    video.set(cv.CAP_PROP_FOURCC, yuyv)
+    if int(video.get(cv.CAP_PROP_FOURCC)) == yuyv:
+        video.set(cv.CAP_PROP_CONVERT_RGB, 0)
+
+
+def _get_v4l2_selection(target: str) -> str | None:
+    # The device's crop selection, in the form --set-selection takes
+    result = subprocess.run(
+        ["v4l2-ctl", "-d", target, "--get-selection=target=crop"],
+        capture_output=True,
+        text=True,
+    )
+    match = re.search(
+        r"Left\s+(-?\d+),\s*Top\s+(-?\d+),\s*Width\s+(\d+),\s*Height\s+(\d+)",
+        result.stdout,
+    )
+    if result.returncode != 0 or match is None:
+        return None
+    left, top, width, height = match.groups()
+    return f"target=crop,left={left},top={top},width={width},height={height}"
+
+
+def _set_v4l2_selection(target: str, selection: str) -> bool:
+    result = subprocess.run(
+        ["v4l2-ctl", "-d", target, f"--set-selection={selection}"],
+        capture_output=True,
+    )
+    return result.returncode == 0
+
+
+class V4l2CropCapture:
+    """
+    A V4L2 camera whose crop selection was changed for this capture. release() puts
+    back the selection the device had before, so it doesn't outlive the process.
+    Everything else goes to the camera's cv.VideoCapture.
+
+    Args:
+        target (str): the camera device.
+        previous_selection (str): the selection to restore, see _get_v4l2_selection.
+
+    """
+
+    def __init__(self, target: str, previous_selection: str):
+        self.capture = cv.VideoCapture(target, cv.CAP_V4L2)
+        self.target = target
+        self.previous_selection = previous_selection
+
+    def release(self) -> None:
+        self.capture.release()
+        if self.previous_selection is not None:
+            _set_v4l2_selection(self.target, self.previous_selection)
+            self.previous_selection = None
+
+    def __getattr__(self, name):
+        return getattr(self.capture, name)
+
+
+def _open_v4l2_cropped(
+    target: str, crop_points: list, grayscale: bool = False
+) -> V4l2CropCapture | None:
+    (y1, y2), (x1, x2) = crop_points
+    h, w = y2 - y1, x2 - x1
+    if shutil.which("v4l2-ctl") is None:
+        return None
+
+    # Without the current selection it couldn't be restored, so it isn't changed
+    previous_selection = _get_v4l2_selection(target)
+    if previous_selection is None:
+        return None
+
+    selection = f"target=crop,left={x1},top={y1},width={w},height={h}"
+    if not _set_v4l2_selection(target, selection):
+        return None
+
+    video = V4l2CropCapture(target, previous_selection)
+    video.set(cv.CAP_PROP_FRAME_WIDTH, w)
+    video.set(cv.CAP_PROP_FRAME_HEIGHT, h)
+    if grayscale:
+        _request_luma(video)
+
+    # Drivers are free to ignore or round the selection, so check what we get
+    ret, frame = video.read()
+    if not ret or frame.shape[:2] != (h, w):
+        video.release()
+        return None
+    return video
+
+
+def open_capture(
+    target,
+    crop_points: list | None,
+    fps: float,
+    capture_crop: bool = False,
+    grayscale: bool = False,
+    retain: int = 1,
+) -> tuple[object, bool]:
+    """
+    Opens a video source. If capture_crop is set, tries to push the crop down into
+    the source: a V4L2 crop selection for /dev/videoN cameras, or an ffmpeg crop
+    filter for saved videos. Falls back to a regular cv.VideoCapture when that is not
+    possible.
+
+    A SharedFrameSource as target gives a CropView of its frames, crop_points is
+    required then. A target of 'bus:<name>' attaches to the frame bus of a capture
+    process, crop_points are then relative to the frames it publishes.
+
+    With grayscale set, cameras are asked for YUYV so the Y plane can be used directly,
+    and the ffmpeg pipe delivers luma only. Sources that can do neither still deliver
+    BGR frames, which the feed converts after cropping.
+
+    Returns:
+        (capture, cropped_at_source): the capture, and whether its frames are already cropped.
+
+    """
+    # Already decoded by a source shared with other feeds
+    if isinstance(target, SharedFrameSource):
+        return (target.view(crop_points), True)
+
+    if isinstance(target, str) and target.startswith("bus:"):
+        reader = FrameBusReader(target[len("bus:") :], retain=retain)
+        height, width = reader.shape[:2]
+        if crop_points is not None and not _crop_inside_frame(
+            crop_points, width, height
+        ):
+            reader.release()
+            raise ValueError(
+                f"crop_points {crop_points} don't fit the {width}x{height} frames of "
+                f"frame bus '{target[len('bus:') :]}', crop_points of an estimator "
+                f"are relative to the frames the capture process publishes"
+            )
+        return (reader, False)
+
+    camera = is_camera(target)
+
+    if camera and capture_crop and crop_points is not None:
+        video = _open_v4l2_cropped(target, crop_points, grayscale)
+        if video is not None:
+            return (video, True)
+
+    if not capture_crop or crop_points is None or camera:
+        video = cv.VideoCapture(target)
+        if camera and grayscale:
+            _request_luma(video)
+        return (video, False)
+
+    video = cv.VideoCapture(target)
+    if shutil.which("ffmpeg") is None or not video.isOpened():
+        return (video, False)
+
+    width = int(video.get(cv.CAP_PROP_FRAME_WIDTH))
+    height = int(video.get(cv.CAP_PROP_FRAME_HEIGHT))
+    if not _crop_inside_frame(crop_points, width, height):
+        return (video, False)
+
+    video.release()
+    return (FfmpegCropCapture(target, crop_points, fps, grayscale), True)
@@ -1,11 +1,51 @@
+import time
+from collections import deque
 import cv2 as cv
 import numpy as np
+from .prefetch import FramePrefetcher
+from .frame_bus import FrameBusReader
+from . import capture
 
 
 class Feed:
+    # How many of the most recent frames a subclass keeps references to between reads.
+    # The prefetch ring must not overwrite these.
+    frames_retained = 1
+
     def __init__(self, **kwargs):
         self.crop_points = kwargs["crop_points"]
         self.frame_cnt = 0
+        self.frames_read = 0
+        self.prefetch_depth = kwargs.get("prefetch_depth", 0)
+        self.prefetch_policy = kwargs.get("prefetch_policy", "block")
+        self.capture_crop = kwargs.get("capture_crop", False)
+        self.grayscale = kwargs.get("grayscale", False)
+
+        # Adaptive decimation, see update_decimation
+        self.adaptive_decimation = kwargs.get("adaptive_decimation", False)
+        self.decimation_max_stride = kwargs.get("decimation_max_stride", 4)
+        self.decimation_samples_per_pass = max(
+            kwargs.get("decimation_samples_per_pass", 20), 2
+        )
+        self.decimation_max_spread = kwargs.get("decimation_max_spread", 0.05)
+        self.stride = 1
+        self.frames_grabbed_only = 0
+
+        # Per-frame timestamps, see _read_timestamp
+        self.timestamp_source = kwargs.get("timestamp_source", "auto")
+        self.frame_timestamp = 0.0
+        self.frame_arrival = 0.0
+        self.timestamps = deque(maxlen=256)
+        # Counts switches to another clock, timestamps from before one don't compare
+        self.clock_changes = 0
+
+        # Deadline-aware dropping for live feeds, see _late_frames
+        self.drop_late_frames = kwargs.get("drop_late_frames", False)
+        self.max_late_drops = kwargs.get("max_late_drops", 4)
+        self.frames_dropped_late = 0
+        self.lag_frames = 0
+        self.frame_age = 0.0
+        self.read_times = deque(maxlen=32)
         self._set_base_config(kwargs["target"], kwargs["fps"])
         self.adjust_contrast: bool
         self.contrast_multiplier: int
@@ -13,9 +53,25 @@ class Feed:
     def _set_base_config(self, target, fps) -> None:
         self.target = target
         self.fps = fps
-        self.video = cv.VideoCapture(self.target)
+        self.video, self.cropped_at_source = capture.open_capture(
+            self.target,
+            self.crop_points,
+            self.fps,
+            self.capture_crop,
+            self.grayscale,
+            retain=self.frames_retained,
+        )
         # self.video.set(cv.CAP_PROP_FPS, self.fps)
 
+        # Decode on a separate thread so it overlaps with detection work
+        if self.prefetch_depth > 0:
+            self.video = FramePrefetcher(
+                self.video,
+                depth=self.prefetch_depth,
+                policy=self.prefetch_policy,
+                retain=self.frames_retained,
+            )
+
         if self.crop_points is not None:
             self.h = self.crop_points[0][1] - self.crop_points[0][0]
             self.w = self.crop_points[1][1] - self.crop_points[1][0]
@@ -23,21 +79,209 @@ class Feed:
             self.xrange = slice(self.crop_points[1][0], self.crop_points[1][1])
         else:
             img = self.get_frame()
-            self.h, self.w, self.ch = img.shape
+            self.h, self.w = img.shape[:2]
             self.yrange = slice(0, self.h)
             self.xrange = slice(0, self.w)
 
     def get_frame(self) -> np.ndarray:
+        # Frames left out by decimation are only grabbed, never decoded. They still
+        # count, so frame_cnt stays in capture frames and frame differences stay valid
+        for _ in range(self.stride - 1):
+            if not self.video.grab():
+                break
+            self.frame_cnt += 1
+            self.frames_grabbed_only += 1
+
+        # Stale frames are dropped the same way, before anything is decoded
+        for _ in range(self._late_frames()):
+            if not self.video.grab():
+                break
+            self.frame_cnt += 1
+            self.frames_dropped_late += 1
+
         ret, frame = self.video.read()
         self.isActive = ret
         if ret:
-            self.frame_cnt += 1
-        if self.crop_points is not None and ret:
-            frame = frame[self.yrange, self.xrange]
+            # A frame bus reader that fell behind skips frames itself, they still count
+            self.count_frame(getattr(self.video, "last_skipped", 0))
+        return self.prepare_frame(frame)
+
+    def count_frame(
+        self,
+        skipped: int = 0,
+        position_msec: float | None = None,
+        arrival: float | None = None,
+    ) -> None:
+        """
+        Frame counts and timestamp of a frame that was just read.
+
+        Args:
+            skipped (int): frames the source skipped before this one.
+            position_msec (float): the source's CAP_PROP_POS_MSEC right after the read,
+                read from the source now if not given.
+            arrival (float): time.monotonic() the frame arrived at, now if not given.
+
+        """
+        self.frame_cnt += 1 + skipped
+        self.frames_read += 1
+        self._read_timestamp(position_msec, arrival)
+        now = time.monotonic()
+        self.frame_age = now - self.frame_arrival
+        self.read_times.append(now)
+
+    def prepare_frame(self, frame: np.ndarray | None) -> np.ndarray | None:
+        # Crop, luma and contrast. Doesn't touch any state, so it can run on another thread
+        if self.crop_points is not None and frame is not None:
+            if not self.cropped_at_source:
+                frame = frame[self.yrange, self.xrange]
+        if self.grayscale and frame is not None:
+            frame = self._to_luma(frame)
         if self.adjust_contrast:
             frame = cv.convertScaleAbs(frame, alpha=self.contrast_multiplier)
         return frame
 
+    def _late_frames(self) -> int:
+        """
+        How many queued frames to drop before the next read. A live source keeps
+        capturing while we process, so everything captured since the previous frame
+        arrived is waiting in its buffer, and only the newest of those is still on time.
+        Dropped frames are counted in frame_cnt, so frame numbers and timestamps stay
+        on the capture clock.
+
+        """
+        if not self.drop_late_frames or self.frames_read == 0:
+            return 0
+
+        elapsed = time.monotonic() - self.frame_arrival
+        self.lag_frames = max(int(elapsed * self.fps) - 1, 0)
+        return min(self.lag_frames, self.max_late_drops)
+
+    def effective_fps(self) -> float:
+        # Processed frames per second over the most recent reads
+        if len(self.read_times) < 2:
+            return 0.0
+        span = self.read_times[-1] - self.read_times[0]
+        return (len(self.read_times) - 1) / span if span > 0 else 0.0
+
+    def live_stats(self) -> dict:
+        return {
+            "lag_frames": self.lag_frames,
+            "frame_age_ms": round(self.frame_age * 1000, 3),
+            "frames_dropped": self.frames_dropped_late,
+            "effective_fps": round(self.effective_fps(), 2),
+        }
+
+    def _read_timestamp(
+        self, position_msec: float | None = None, arrival: float | None = None
+    ) -> None:
+        # The prefetcher notes when a frame was decoded, otherwise it arrived just now
+        if arrival is None:
+            arrival = getattr(self.video, "last_arrival", None) or time.monotonic()
+
+        if self.timestamp_source == "fps":
+            timestamp = (self.frame_cnt - 1) / self.fps
+        elif self.timestamp_source == "monotonic":
+            timestamp = arrival
+        else:
+            if position_msec is None:
+                position_msec = self.video.get(cv.CAP_PROP_POS_MSEC)
+            timestamp = position_msec / 1000
+
+            # 'auto' gives up on sources whose timestamps don't advance
+            if (
+                self.timestamp_source == "auto"
+                and self.timestamps
+                and timestamp <= self.frame_timestamp
+            ):
+                self.timestamp_source = "monotonic"
+                self.timestamps.clear()
+                self.clock_changes += 1
+                timestamp = arrival
+
+            # Capture times on the monotonic clock are the better arrival time for
+            # latency accounting
+            elif self.capture_times_monotonic():
+                arrival = timestamp
+
+        self.frame_timestamp = timestamp
+        self.frame_arrival = arrival
+        self.timestamps.append((self.frame_cnt, timestamp))
+
+    def capture_times_monotonic(self) -> bool:
+        # V4L2 buffer timestamps are on the monotonic clock, and so are the ones a
+        # capture process that reads a camera puts on a frame bus
+        return getattr(self.video, "monotonic_times", capture.is_camera(self.target))
+
+    def timestamps_monotonic(self) -> bool:
+        # Whether frame_timestamp is on the time.monotonic() clock
+        if self.timestamp_source == "monotonic":
+            return True
+        if self.timestamp_source == "fps":
+            return False
+        return self.capture_times_monotonic()
+
+    def timestamp_at(self, frame: float) -> float:
+        """
+        Capture time in seconds of a (possibly fractional) frame number, interpolated
+        between the timestamps of the frames around it. Frames older than the kept
+        history are extrapolated at the nominal fps.
+
+        Args:
+            frame (float): frame number, as in frame_cnt.
+
+        """
+        frames, timestamps = zip(*self.timestamps)
+        if frame < frames[0]:
+            return timestamps[0] - (frames[0] - frame) / self.fps
+        return float(np.interp(frame, frames, timestamps))
+
+    @staticmethod
+    def _to_luma(frame: np.ndarray) -> np.ndarray:
+        if frame.ndim == 2:
+            return frame
+        # Raw YUYV from the camera, the Y plane is channel 0
+        if frame.shape[2] == 2:
+            return np.ascontiguousarray(frame[:, :, 0])
+        return cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+
+    def update_decimation(self, rpm: float, rpm_spread: float) -> None:
+        """
+        Picks how many capture frames to advance per processed frame. A blade pass
+        (3 per rotation) should still span decimation_samples_per_pass processed frames,
+        which is never below the Nyquist limit of 2. Goes back to full rate when there is
+        no estimate, or when the relative spread of recent estimates is above
+        decimation_max_spread.
+
+        Args:
+            rpm (float): current RPM estimate, 0 if there is none.
+            rpm_spread (float): relative spread (std / mean) of the recent estimates.
+
+        """
+        if not self.adaptive_decimation:
+            return
+        if rpm <= 0 or rpm_spread > self.decimation_max_spread:
+            self.stride = 1
+            return
+
+        blade_pass_frequency = 3 * rpm / 60
+        stride = int(
+            self.fps / (self.decimation_samples_per_pass * blade_pass_frequency)
+        )
+        self.stride = max(1, min(stride, self.decimation_max_stride))
+
+    def prefetch_stats(self) -> dict | None:
+        if isinstance(self.video, FramePrefetcher):
+            return self.video.stats()
+        return None
+
+    def bus_stats(self) -> dict | None:
+        if isinstance(self.video, FrameBusReader):
+            return self.video.stats()
+        return None
+
+    def release(self) -> None:
+        self.video.release()
+
 
 class RpmFromFeed(Feed):
     def __init__(self, **kwargs):
@@ -114,6 +358,15 @@ class Draw:
         )
         return new_frame
 
+    def colour_view(self, image: np.ndarray) -> np.ndarray:
+        # Drawing needs 3 channels. Colour images are returned as-is (not copied),
+        # unless they are read-only views of a frame bus
+        if image.ndim == 2:
+            return cv.cvtColor(image, cv.COLOR_GRAY2BGR)
+        if not image.flags.writeable:
+            return image.copy()
+        return image
+
     def processing_results(
         self, frame: np.ndarray, region: tuple[slice, slice], value: np.ndarray
     ) -> np.ndarray:
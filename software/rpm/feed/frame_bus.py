@@ -0,0 +1,362 @@
+import os
+import time
+from collections import deque
+from multiprocessing import resource_tracker, shared_memory
+import cv2 as cv
+import numpy as np
+
+# Header fields, all int64
+HEAD = 0  # Sequence number of the newest frame, frames start at 1
+CLOSED = 1
+SLOTS = 2
+MAX_CONSUMERS = 3
+HEIGHT = 4
+WIDTH = 5
+CHANNELS = 6  # 0 for single-channel frames
+WRITER_PID = 7
+MONOTONIC_TIMES = 8  # 1 if the frame timestamps are on the time.monotonic() clock
+HEADER_SIZE = 9
+
+
+def _layout(slots: int, max_consumers: int, shape: tuple) -> tuple[dict, int]:
+    # Byte offsets of every array in the shared block, and its total size
+    offsets = {}
+    size = HEADER_SIZE * 8
+    for name, length in (
+        ("slot_seq", slots),
+        ("slot_time", slots),
+        ("slot_arrival", slots),
+        ("consumer_pid", max_consumers),
+        ("consumer_seq", max_consumers),
+    ):
+        offsets[name] = size
+        size += length * 8
+
+    # Frames start on a cache line
+    size = (size + 63) // 64 * 64
+    offsets["frames"] = size
+    size += slots * int(np.prod(shape))
+    return (offsets, size)
+
+
+def _map_arrays(buf, slots: int, max_consumers: int, shape: tuple) -> dict:
+    offsets, _ = _layout(slots, max_consumers, shape)
+    arrays = {"header": np.ndarray((HEADER_SIZE,), np.int64, buf, 0)}
+    for name, dtype, length in (
+        ("slot_seq", np.int64, slots),
+        ("slot_time", np.float64, slots),
+        ("slot_arrival", np.float64, slots),
+        ("consumer_pid", np.int64, max_consumers),
+        ("consumer_seq", np.int64, max_consumers),
+    ):
+        arrays[name] = np.ndarray((length,), dtype, buf, offsets[name])
+    arrays["frames"] = np.ndarray((slots,) + shape, np.uint8, buf, offsets["frames"])
+    return arrays
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class FrameBusWriter:
+    """
+    Producer side of a frame bus: a ring of frame slots in shared memory, with a
+    sequence number and timestamps per slot, that FrameBusReaders in other processes
+    read without copying. Publishing never waits for the readers. A reader that falls
+    more than half the ring behind skips ahead to the newest frame, and shows up in
+    slow_consumers().
+
+    Args:
+        name (str): name of the shared memory block, readers attach with it.
+        shape (tuple): shape of every frame, (h, w) or (h, w, channels).
+        slots (int): number of frames in the ring.
+        max_consumers (int): how many readers can be attached at once.
+
+    """
+
+    def __init__(
+        self, name: str, shape: tuple, slots: int = 32, max_consumers: int = 8
+    ):
+        if slots < 4:
+            raise ValueError("A frame bus needs at least 4 slots")
+
+        self.slots = slots
+        self.max_consumers = max_consumers
+        _, size = _layout(slots, max_consumers, shape)
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # Left behind by a capture process that didn't shut down cleanly,
+            # unless its writer is still running
+            stale = shared_memory.SharedMemory(name=name)
+            writer_pid = 0
+            if stale.size >= HEADER_SIZE * 8:
+                header = np.ndarray((HEADER_SIZE,), np.int64, stale.buf, 0)
+                writer_pid = int(header[WRITER_PID])
+                del header
+            stale.close()
+            if writer_pid not in (0, os.getpid()) and _process_alive(writer_pid):
+                # Only attached, exiting mustn't unlink it under the running writer
+                resource_tracker.unregister(stale._name, "shared_memory")
+                raise FileExistsError(
+                    f"Frame bus '{name}' is already published by process {writer_pid}"
+                )
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+
+        arrays = _map_arrays(self.shm.buf, slots, max_consumers, shape)
+        self.header = arrays["header"]
+        self.slot_seq = arrays["slot_seq"]
+        self.slot_time = arrays["slot_time"]
+        self.slot_arrival = arrays["slot_arrival"]
+        self.consumer_pid = arrays["consumer_pid"]
+        self.consumer_seq = arrays["consumer_seq"]
+        self.frames = arrays["frames"]
+
+        self.header[:] = 0
+        self.header[SLOTS] = slots
+        self.header[MAX_CONSUMERS] = max_consumers
+        self.header[HEIGHT] = shape[0]
+        self.header[WIDTH] = shape[1]
+        self.header[CHANNELS] = shape[2] if len(shape) == 3 else 0
+        self.header[WRITER_PID] = os.getpid()
+        self.slot_seq[:] = 0
+        self.consumer_pid[:] = 0
+
+    def publish(
+        self,
+        frame: np.ndarray,
+        timestamp: float,
+        arrival: float,
+        monotonic_times: bool = False,
+    ) -> int:
+        seq = int(self.header[HEAD]) + 1
+        slot = seq % self.slots
+
+        # Readers check the sequence number, so a slot being written is never taken
+        self.slot_seq[slot] = -1
+        self.frames[slot] = frame
+        self.slot_time[slot] = timestamp
+        self.slot_arrival[slot] = arrival
+        self.slot_seq[slot] = seq
+        self.header[MONOTONIC_TIMES] = monotonic_times
+        self.header[HEAD] = seq
+        return seq
+
+    def slow_consumers(self) -> list[tuple[int, int]]:
+        """
+        Readers that are far enough behind to be skipping frames.
+
+        Returns:
+            list[tuple[int, int]]: (pid, frames behind) of every slow reader.
+
+        """
+        head = int(self.header[HEAD])
+        slow = []
+        for i in range(self.max_consumers):
+            pid = int(self.consumer_pid[i])
+            if pid == 0:
+                continue
+
+            # A reader that died without detaching gives its place back
+            if not _process_alive(pid):
+                self.consumer_pid[i] = 0
+                continue
+
+            behind = head - int(self.consumer_seq[i])
+            if behind >= self.slots // 2:
+                slow.append((pid, behind))
+        return slow
+
+    def consumers(self) -> int:
+        return int(np.count_nonzero(self.consumer_pid))
+
+    def release(self) -> None:
+        # Readers see the bus closed once they've read what is left
+        self.header[CLOSED] = 1
+        del self.header, self.slot_seq, self.slot_time, self.slot_arrival
+        del self.consumer_pid, self.consumer_seq, self.frames
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            # Already removed, e.g. by hand or by a writer that replaced a stale bus
+            pass
+
+
+class FrameBusReader:
+    """
+    Consumer side of a frame bus. Mimics the parts of cv.VideoCapture that the feeds
+    use. read() returns a read-only numpy view into the shared ring and starts at the
+    newest frame. A view stays valid until the writer comes around the ring, which
+    read() keeps more than half the ring away by skipping ahead when it falls behind.
+    A frame that is held longer than that (a stall of about slots/2 - retain frame
+    periods) is overwritten while in use. That is detected once the frame is let go,
+    and counted in frames_overwritten. frame_intact() checks the newest frame.
+
+    Args:
+        name (str): name the FrameBusWriter was created with.
+        retain (int): how many of the most recently read frames the feed holds on to.
+        timeout (float): seconds to wait for a new frame before giving up on the writer.
+
+    """
+
+    def __init__(self, name: str, retain: int = 1, timeout: float = 5.0):
+        try:
+            self.shm = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            raise FileNotFoundError(
+                f"No frame bus named '{name}', start the capture process first"
+            ) from None
+
+        # The writer owns the memory, it must outlive this process
+        resource_tracker.unregister(self.shm._name, "shared_memory")
+
+        header = np.ndarray((HEADER_SIZE,), np.int64, self.shm.buf, 0)
+        self.slots = int(header[SLOTS])
+        self.max_consumers = int(header[MAX_CONSUMERS])
+        shape = (int(header[HEIGHT]), int(header[WIDTH]))
+        if header[CHANNELS]:
+            shape += (int(header[CHANNELS]),)
+        del header
+
+        arrays = _map_arrays(self.shm.buf, self.slots, self.max_consumers, shape)
+        self.header = arrays["header"]
+        self.slot_seq = arrays["slot_seq"]
+        self.slot_time = arrays["slot_time"]
+        self.slot_arrival = arrays["slot_arrival"]
+        self.consumer_pid = arrays["consumer_pid"]
+        self.consumer_seq = arrays["consumer_seq"]
+        self.frames = arrays["frames"]
+        self.frames.flags.writeable = False
+
+        self.shape = shape
+        self.retain = retain
+        self.timeout = timeout
+        self.next_seq = max(int(self.header[HEAD]), 1)
+        self.seq = 0
+        self.slot = 0
+        self.frames_overrun = 0
+        self.frames_overwritten = 0
+        self.last_skipped = 0
+        # (slot, seq) of the frames the feed holds on to
+        self.held = deque()
+        self.index = self._attach()
+
+    def _attach(self) -> int:
+        # Take a free place in the consumer table, so the writer can see how far behind we are
+        pid = os.getpid()
+        for i in range(self.max_consumers):
+            if self.consumer_pid[i] == 0:
+                self.consumer_seq[i] = self.next_seq - 1
+                self.consumer_pid[i] = pid
+                return i
+        raise RuntimeError(
+            f"All {self.max_consumers} consumer places of the frame bus are taken"
+        )
+
+    def frame_intact(self) -> bool:
+        # False if the newest frame read was overwritten since
+        return self.seq == 0 or self.slot_seq[self.slot] == self.seq
+
+    def _let_go(self, keep: int) -> None:
+        # Frames that were overwritten while the feed held them were torn
+        while len(self.held) > keep:
+            slot, seq = self.held.popleft()
+            if self.slot_seq[slot] != seq:
+                self.frames_overwritten += 1
+
+    def _advance(self) -> bool:
+        # The oldest retained frame goes out of use with this read
+        self._let_go(self.retain - 1)
+        expected = self.next_seq
+        deadline = time.monotonic() + self.timeout
+        while True:
+            while self.header[HEAD] < self.next_seq:
+                if self.header[CLOSED] or time.monotonic() > deadline:
+                    return False
+                time.sleep(0.001)
+
+            # Too far behind: what we'd read and what we hold on to is about to be
+            # overwritten. Go to the newest frame, the skipped ones still count
+            head = int(self.header[HEAD])
+            if head - self.next_seq >= self.slots // 2 - self.retain:
+                self.next_seq = head
+
+            seq = self.next_seq
+            if self.slot_seq[seq % self.slots] == seq:
+                break
+
+            # Overwritten while we looked, which only happens when far behind
+            self.next_seq = int(self.header[HEAD])
+
+        self.seq = seq
+        self.slot = seq % self.slots
+        self.next_seq = seq + 1
+        self.last_skipped = seq - expected
+        self.frames_overrun += self.last_skipped
+        self.consumer_seq[self.index] = seq
+        self.held.append((self.slot, seq))
+        return True
+
+    @property
+    def last_arrival(self) -> float:
+        return float(self.slot_arrival[self.slot])
+
+    @property
+    def monotonic_times(self) -> bool:
+        # Set by the capture process, true when it reads a camera
+        return bool(self.header[MONOTONIC_TIMES])
+
+    def isOpened(self) -> bool:
+        return not self.header[CLOSED] or self.header[HEAD] >= self.next_seq
+
+    def read(self) -> tuple[bool, np.ndarray | None]:
+        if not self._advance():
+            return (False, None)
+        return (True, self.frames[self.slot])
+
+    def grab(self) -> bool:
+        # A grabbed frame is never handed out, so it's never in use
+        if not self._advance():
+            return False
+        self.held.pop()
+        return True
+
+    def get(self, prop: int) -> float:
+        if prop == cv.CAP_PROP_POS_MSEC:
+            return float(self.slot_time[self.slot]) * 1000
+        if prop == cv.CAP_PROP_POS_FRAMES:
+            return float(self.seq)
+        if prop == cv.CAP_PROP_FRAME_WIDTH:
+            return float(self.shape[1])
+        if prop == cv.CAP_PROP_FRAME_HEIGHT:
+            return float(self.shape[0])
+        return 0.0
+
+    def set(self, prop: int, value: float) -> bool:
+        return False
+
+    def stats(self) -> dict:
+        return {
+            "frames_skipped": self.frames_overrun,
+            "frames_overwritten": self.frames_overwritten,
+        }
+
+    def release(self) -> None:
+        self._let_go(0)
+        self.consumer_pid[self.index] = 0
+        del self.header, self.slot_seq, self.slot_time, self.slot_arrival
+        del self.consumer_pid, self.consumer_seq, self.frames
+
+        # Frames the feed still holds keep the mapping alive, it goes with the process
+        try:
+            self.shm.close()
+        except BufferError:
+            pass
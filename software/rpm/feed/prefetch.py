@@ -0,0 +1,166 @@
+import threading
+import time
+from collections import deque
+
+import cv2 as cv
+import numpy as np
+
+
+class FramePrefetcher:
+    """
+    Decodes frames from a capture on a background thread into a bounded ring of
+    preallocated frame slots. Mimics the read() interface of cv.VideoCapture so it
+    can be dropped in wherever a capture is used.
+
+    A frame returned by read() stays valid until `retain` newer frames have been read,
+    after which its slot is handed back to the decoder and overwritten.
+
+    Args:
+        capture (cv.VideoCapture): an opened capture (or anything with read()/release()).
+        depth (int): how many decoded frames may be queued ahead of the consumer.
+        policy (str): either 'block' or 'drop_oldest'. What the decoder does when the ring is full.
+        retain (int): how many of the most recently read frames the consumer may hold on to.
+
+    """
+
+    POLICIES = ("block", "drop_oldest")
+
+    def __init__(self, capture, depth: int = 4, policy: str = "block", retain: int = 1):
+        if depth < 1:
+            raise ValueError("Prefetch depth must be at least 1")
+        if policy not in self.POLICIES:
+            raise ValueError(
+                f"Unknown prefetch policy '{policy}', use one of {self.POLICIES}"
+            )
+
+        self.capture = capture
+        self.depth = depth
+        self.policy = policy
+
+        # Frames are decoded straight into these. They are allocated on first use
+        # and then reused for the rest of the run.
+        self._slots: list[np.ndarray | None] = [None] * (depth + retain)
+
+        # Capture timestamp (ms) and monotonic arrival time of every slot, taken on the
+        # decode thread since the capture itself is already ahead of the consumer
+        self._timestamps = [0.0] * (depth + retain)
+        self._arrivals = [0.0] * (depth + retain)
+        self.last_timestamp = 0.0
+        self.last_arrival = 0.0
+        self._free = deque(range(depth + retain))
+        self._filled = deque()
+        self._held = deque(maxlen=retain)
+
+        self._cond = threading.Condition()
+        self._finished = False
+        self._stopped = False
+        # Raised by the capture on the decode thread, read() raises it again
+        self._error: Exception | None = None
+
+        # Counters
+        self.frames_decoded = 0
+        self.frames_dropped = 0
+        self.consumer_wait_time = 0.0
+        self.producer_wait_time = 0.0
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _acquire_slot(self) -> int | None:
+        # Called with the condition held
+        while not self._free and not self._stopped:
+            if self.policy == "drop_oldest" and self._filled:
+                self.frames_dropped += 1
+                return self._filled.popleft()
+            wait_start = time.perf_counter()
+            self._cond.wait()
+            self.producer_wait_time += time.perf_counter() - wait_start
+
+        if self._stopped:
+            return None
+        return self._free.popleft()
+
+    def _run(self) -> None:
+        try:
+            while True:
+                with self._cond:
+                    slot = self._acquire_slot()
+                if slot is None:
+                    break
+
+                # Decoding happens outside the lock, OpenCV releases the GIL here
+                ret, frame = self.capture.read(self._slots[slot])
+
+                with self._cond:
+                    if not ret:
+                        self._free.append(slot)
+                        break
+                    self._slots[slot] = frame
+                    self._timestamps[slot] = self.capture.get(cv.CAP_PROP_POS_MSEC)
+                    self._arrivals[slot] = time.monotonic()
+                    self._filled.append(slot)
+                    self.frames_decoded += 1
+                    self._cond.notify_all()
+        except Exception as error:
+            self._error = error
+        finally:
+            # However decoding ends, read() must not wait for frames that won't come
+            with self._cond:
+                self._finished = True
+                self._cond.notify_all()
+
+    def read(self) -> tuple[bool, np.ndarray | None]:
+        with self._cond:
+            wait_start = time.perf_counter()
+            while not self._filled and not self._finished:
+                self._cond.wait()
+            self.consumer_wait_time += time.perf_counter() - wait_start
+
+            if not self._filled:
+                if self._error is not None:
+                    raise self._error
+                return (False, None)
+
+            slot = self._filled.popleft()
+
+            # The oldest held frame is no longer in use, give its slot back
+            if len(self._held) == self._held.maxlen:
+                self._free.append(self._held[0])
+            self._held.append(slot)
+            self.last_timestamp = self._timestamps[slot]
+            self.last_arrival = self._arrivals[slot]
+            self._cond.notify_all()
+
+            return (True, self._slots[slot])
+
+    def grab(self) -> bool:
+        # The frame is already decoded, so skipping it just hands its slot back
+        ret, _ = self.read()
+        return ret
+
+    def get(self, prop: int) -> float:
+        # Timestamps belong to the last frame read, not to the one being decoded
+        if prop == cv.CAP_PROP_POS_MSEC:
+            return self.last_timestamp
+        return self.capture.get(prop)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "frames_decoded": self.frames_decoded,
+                "frames_dropped": self.frames_dropped,
+                "frames_queued": len(self._filled),
+                "consumer_wait_time": round(self.consumer_wait_time, 3),
+                "producer_wait_time": round(self.producer_wait_time, 3),
+            }
+
+    def release(self) -> None:
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join()
+        self.capture.release()
+
+    def __getattr__(self, name):
+        # Anything we do not override (get, set, isOpened...) goes to the capture
+        return getattr(self.capture, name)
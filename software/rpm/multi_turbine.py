@@ -0,0 +1,106 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import cv2 as cv
+from . import bpm_cascade
+from .bpm_runner import BpmRunner
+from .feed.capture import SharedFrameSource
+
+
+def turbine_params(params: dict) -> list[dict]:
+    """
+    Splits a multi-turbine config into one config per turbine: every entry of
+    'turbines' overrides the settings shared by all of them.
+
+    Args:
+        params (dict from JSON-config file): see software/config/config_template.json.
+
+    """
+    shared = {key: value for key, value in params.items() if key != "turbines"}
+    configs = []
+    for i, turbine in enumerate(params["turbines"]):
+        config = {**shared, "id": i, **turbine}
+        if config.get("crop_points") is None:
+            raise ValueError(f"Turbine {config['id']} needs its own crop_points")
+
+        # Frames are decoded once for all turbines, so skipping frames and cropping
+        # at the source are up to the shared source. The time between a turbine's
+        # frames includes the other turbines' work, so it can't scale its resolution
+        config.update(
+            prefetch_depth=0,
+            capture_crop=False,
+            adaptive_decimation=False,
+            drop_late_frames=False,
+            resolution_scaling=False,
+        )
+        configs.append(config)
+    return configs
+
+
+def run(params: dict, deploy: bool = False, output_dir: str = "runs") -> None:
+    """
+    Runs bpm detection for several turbines in one video. Each frame is decoded once,
+    every turbine gets a view of its own crop, and rows go to one output file per
+    turbine (out_<id>.csv). With turbine_workers above 1, the turbines of a frame are
+    processed on a thread pool. OpenCV releases the GIL during morphology, so they do
+    run in parallel.
+
+    Args:
+        params (dict from JSON-config file): see software/config/config_template.json.
+        deploy (bool): write rows to files instead of showing the processing.
+        output_dir (str): where the per-turbine output files go.
+
+    """
+    source = SharedFrameSource(
+        params["target"],
+        params["fps"],
+        params.get("prefetch_depth", 0),
+        params.get("prefetch_policy", "block"),
+    )
+
+    runners = []
+    output_files = []
+    for config in turbine_params(params):
+        feed = bpm_cascade.BpmCascade(**{**config, "target": source})
+        output_file = None
+        if deploy:
+            os.makedirs(output_dir, exist_ok=True)
+            path = os.path.join(output_dir, f"out_{config['id']}.csv")
+            output_file = open(path, "w", buffering=1)
+            start_time = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+            output_file.write(f"Logging started at {start_time}\n")
+            output_files.append(output_file)
+        runners.append(BpmRunner(feed, config, deploy, output_file))
+
+    workers = params.get("turbine_workers", 1)
+    pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        while source.advance():
+            # Views are cheap, take them on this thread so frame counts stay in step
+            frames = [runner.feed.get_frame() for runner in runners]
+            if pool is not None:
+                display_frames = list(pool.map(BpmRunner.process, runners, frames))
+            else:
+                display_frames = [
+                    runner.process(frame) for runner, frame in zip(runners, frames)
+                ]
+
+            # HighGUI wants to be called from one thread
+            if not deploy:
+                for runner, display_frame in zip(runners, display_frames):
+                    cv.imshow(f"Image feed {runner.feed.id}", display_frame)
+                k = cv.waitKey(1) & 0xFF
+                if k == 27:
+                    break
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    end_time = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+    for runner in runners:
+        print(f"Turbine {runner.feed.id}:")
+        runner.finish()
+    for output_file in output_files:
+        output_file.write(f"Logging ended at {end_time}\n")
+        output_file.close()
+    source.release()
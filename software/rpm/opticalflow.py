@@ -17,7 +17,12 @@ class OpticalFlow(feed.RpmFromFeed):
 
     """
 
+    # The previous frame is kept around for tracking
+    frames_retained = 2
+
     def __init__(self, **kwargs):
+        # Luma-only frames are a bpm cascade option, tracking converts frames itself
+        kwargs["grayscale"] = False
         for key, value in kwargs.items():
             setattr(self, key, value)
         super().__init__(**kwargs)
@@ -28,39 +33,82 @@ class OpticalFlow(feed.RpmFromFeed):
         self.deadzone_offset_y: int
         self.pixel_threshold: int
 
+        # Persistent feature tracking, see get_optical_flow_vectors
+        self.track_features = kwargs.get("track_features", False)
+        self.min_tracked_features = kwargs.get("min_tracked_features", 20)
+        self.feature_redetect_interval = kwargs.get("feature_redetect_interval", 30)
+        self.tracked_points = None
+        self.steps_since_detection = 0
+        self.flow_steps = 0
+        self.feature_detections = 0
+
+        # Grayscale version of the previous frame, reused as the "previous" side of
+        # the next step so every frame is converted only once
+        self.reuse_flow_grayscale = kwargs.get("reuse_flow_grayscale", True)
+        self.prev_frame_gray = None
+
+        # Track on the raw crop and only correct the point coordinates for perspective
+        self.warp_tracked_points = kwargs.get("warp_tracked_points", False)
+
+        # Either 'magnitude' (mean vector length over radius_max) or 'angular'
+        # (per-point angular velocity around the hub)
+        self.flow_estimator = kwargs.get("flow_estimator", "magnitude")
+        self.min_flow_confidence = kwargs.get("min_flow_confidence", 0.0)
+        self.rpm_confidence = None
+
         self._set_initial_frame(self.ground_angle)
         self._set_mask_size()
 
         # Algorithm config
-        self.st_params = self.set_shi_tomasi_params()
+        self.st_params = self.set_shi_tomasi_params(
+            maxCorners=kwargs.get("max_corners", 100)
+        )
         self.lk_params = self.set_lucas_kanade_params()
         self.set_deadzone_size(self.deadzone_size)
+
+        # The deadzone is defined on the perspective corrected image
+        mask_template = self.prev_frame
+        if self._warps_points():
+            mask_template = np.empty(
+                (self.corrected_size, self.corrected_size) + self.prev_frame.shape[2:],
+                dtype=np.uint8,
+            )
+
         if self.deadzone_shape.lower() == "circle":
             deadzone_radius = int(
                 math.sqrt(self.deadzone_size[0] * self.deadzone_size[1])
             )
             self.feature_mask = self.generate_circular_feature_mask_matrix(
-                self.prev_frame,
+                mask_template,
                 self.deadzone_offset_x,
                 self.deadzone_offset_y,
                 deadzone_radius,
             )
         else:
             self.feature_mask = self.generate_feature_mask_matrix(
-                self.prev_frame, self.deadzone_offset_x, self.deadzone_offset_y
+                mask_template, self.deadzone_offset_x, self.deadzone_offset_y
             )
 
+        if self._warps_points():
+            self._unwarp_feature_mask()
+
         # Color for drawing purposes
-        self.color = np.random.randint(0, 255, (100, 3))
+        self.color = np.random.randint(0, 255, (self.st_params["maxCorners"], 3))
 
     def get_frame(self) -> np.ndarray:
         ret, frame = self.video.read()
         self.isActive = ret
-
-        if self.crop_points is not None and self.isActive:
+        if ret:
+            self.count_frame(getattr(self.video, "last_skipped", 0))
+
+        if (
+            self.crop_points is not None
+            and self.isActive
+            and not self.cropped_at_source
+        ):
             frame = frame[self.yrange, self.xrange]
 
-        if self.shape == "RECT" and ret:
+        if self.shape == "RECT" and ret and not self.warp_tracked_points:
             frame = self._correct_frame_perspective(frame)
 
         return frame
@@ -70,7 +118,7 @@ class OpticalFlow(feed.RpmFromFeed):
         self.prev_frame = self.get_frame()
 
     def _set_mask_size(self):
-        self.mask = np.zeros_like(self.prev_frame)
+        self.mask = np.zeros(self.prev_frame.shape[:2] + (3,), dtype=np.uint8)
 
     def set_perspective_parameters(self, ground_angle):
         # Do a whole lot of trig to correct for persepective
@@ -92,6 +140,7 @@ class OpticalFlow(feed.RpmFromFeed):
         )  # bottom-left
 
         new_h = self.h if (self.h > self.w) else self.w
+        self.corrected_size = new_h
         pts_dst = np.array(
             [
                 [0, 0],  # top-left in the new image
@@ -105,9 +154,45 @@ class OpticalFlow(feed.RpmFromFeed):
         self.translation_matrix = cv.getPerspectiveTransform(pts_src, pts_dst)
 
     def _correct_frame_perspective(self, frame):
-        warped = cv.warpPerspective(frame, self.translation_matrix, (self.h, self.h))
+        warped = cv.warpPerspective(
+            frame, self.translation_matrix, (self.corrected_size, self.corrected_size)
+        )
         return warped
 
+    def _warps_points(self) -> bool:
+        return self.warp_tracked_points and self.shape == "RECT"
+
+    def _unwarp_feature_mask(self) -> None:
+        # Bring the deadzone from corrected coordinates back to the raw crop
+        h, w = self.prev_frame.shape[:2]
+        self.feature_mask = cv.warpPerspective(
+            self.feature_mask,
+            self.translation_matrix,
+            (w, h),
+            flags=cv.INTER_NEAREST | cv.WARP_INVERSE_MAP,
+        )
+        fromx, tox, fromy, toy = self.maskpoints
+        corners = np.array([[[fromx, fromy]], [[tox, toy]]], dtype=np.float32)
+        inverse = np.linalg.inv(self.translation_matrix)
+        (fromx, fromy), (tox, toy) = (
+            cv.perspectiveTransform(corners, inverse).reshape(-1, 2).round().astype(int)
+        ).tolist()
+        self.maskpoints = [fromx, tox, fromy, toy]
+
+    def corrected_motion_vectors(
+        self, new_points: np.ndarray, old_points: np.ndarray
+    ) -> np.ndarray:
+        # With warp_tracked_points, points are tracked on the raw crop. Mapping only
+        # the point coordinates gives the same vectors as tracking on a warped frame.
+        if self._warps_points():
+            new_points = self._correct_points_perspective(new_points)
+            old_points = self._correct_points_perspective(old_points)
+        return new_points - old_points
+
+    def _correct_points_perspective(self, points: np.ndarray) -> np.ndarray:
+        pts = np.asarray(points, dtype=np.float32).reshape(-1, 1, 2)
+        return cv.perspectiveTransform(pts, self.translation_matrix).reshape(-1, 2)
+
     def set_deadzone_size(self, size):
         if size is not None:
             self.deadzone_size_x, self.deadzone_size_y = size
@@ -146,7 +231,7 @@ class OpticalFlow(feed.RpmFromFeed):
         self, image: np.ndarray, deadzone_offset_x, deadzone_offset_y
     ) -> np.ndarray:
         size = [self.deadzone_size_x, self.deadzone_size_y]
-        height, width, channels = image.shape
+        height, width = image.shape[:2]
         mask = np.full((height, width), 255, dtype=np.uint8)
         x_left, x_right, y_top, y_bottom = self.translate_coords_to_center(
             height, width, *size
@@ -170,7 +255,7 @@ class OpticalFlow(feed.RpmFromFeed):
         deadzone_offset_y: int,
         radius: int,
     ):
-        h, w, ch = image.shape
+        h, w = image.shape[:2]
         mask = np.full((h, w), 255, dtype=np.uint8)
 
         radius_y = (h // 2) + deadzone_offset_y
@@ -188,11 +273,55 @@ class OpticalFlow(feed.RpmFromFeed):
     def calculate_rpm_from_vectors(self, motion_vectors) -> float | None:
         return crpm.get_rpm_from_flow_vectors(motion_vectors, self.radius_max, self.fps)
 
+    def get_hub_center(self) -> tuple[float, float]:
+        # The deadzone offsets (and the deadzone itself) live in the corrected space
+        center = np.array([self.get_center_pixel()], dtype=np.float32)
+        if self.shape == "RECT":
+            center = self._correct_points_perspective(center)
+        return (
+            float(center[0][0]) + self.deadzone_offset_x,
+            float(center[0][1]) + self.deadzone_offset_y,
+        )
+
+    def estimate_rpm(
+        self, new_points: np.ndarray, old_points: np.ndarray
+    ) -> float | None:
+        # Corrects and scales the tracked motion, then runs the configured estimator.
+        # rpm_confidence is only set by the angular estimator.
+        motion_vectors = self.corrected_motion_vectors(new_points, old_points)
+        scaled_vectors = motion_vectors * self.rpm_scaling_factor
+
+        if self.flow_estimator != "angular":
+            return self.calculate_rpm_from_vectors(scaled_vectors)
+
+        # Points sit halfway along their motion during the step
+        positions = (
+            self._corrected_points(new_points) + self._corrected_points(old_points)
+        ) / 2
+        rpm, self.rpm_confidence = crpm.get_rpm_from_angular_velocities(
+            positions, scaled_vectors, self.get_hub_center(), self.fps
+        )
+        if self.rpm_confidence < self.min_flow_confidence:
+            return None
+        return rpm
+
+    def _corrected_points(self, points: np.ndarray) -> np.ndarray:
+        if self._warps_points():
+            return self._correct_points_perspective(points)
+        return np.asarray(points, dtype=np.float32).reshape(-1, 2)
+
     def draw_optical_flow(
         self, image: np.ndarray, old_points: list, new_points: list, overwrite=False
     ) -> np.ndarray:
         if overwrite:
-            self.mask = np.zeros_like(image)
+            self.mask = np.zeros(image.shape[:2] + (3,), dtype=np.uint8)
+
+        # Frames from a luma-only frame bus are drawn on a colour copy, colour
+        # frames from a frame bus are read-only views
+        if image.ndim == 2:
+            image = cv.cvtColor(image, cv.COLOR_GRAY2BGR)
+        elif not image.flags.writeable:
+            image = image.copy()
 
         for i, (new, old) in enumerate(zip(new_points, old_points)):
             a, b = new.ravel()
@@ -212,22 +341,67 @@ class OpticalFlow(feed.RpmFromFeed):
 
         return cv.add(self.mask, image)
 
+    @staticmethod
+    def to_gray(frame: np.ndarray) -> np.ndarray:
+        # Frames from a frame bus that publishes luma only are gray already
+        if frame.ndim == 2:
+            return frame
+        return cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+
+    def _get_features_to_track(self, prev_frame_gray: np.ndarray) -> np.ndarray | None:
+        self.flow_steps += 1
+
+        # Keep following the points from the last step while there are enough of them
+        if self.track_features and self.tracked_points is not None:
+            self.steps_since_detection += 1
+            if (
+                len(self.tracked_points) >= self.min_tracked_features
+                and self.steps_since_detection < self.feature_redetect_interval
+            ):
+                return self.tracked_points
+
+        self.feature_detections += 1
+        self.steps_since_detection = 0
+        return cv.goodFeaturesToTrack(
+            prev_frame_gray, mask=self.feature_mask, **self.st_params
+        )
+
+    def _prune_tracked_points(self, points: np.ndarray) -> np.ndarray:
+        # Drop points that left the frame or moved into the deadzone
+        xy = np.rint(points.reshape(-1, 2)).astype(int)
+        h, w = self.feature_mask.shape
+        keep = (xy[:, 0] >= 0) & (xy[:, 0] < w) & (xy[:, 1] >= 0) & (xy[:, 1] < h)
+        keep[keep] = self.feature_mask[xy[keep, 1], xy[keep, 0]] > 0
+        return points.reshape(-1, 1, 2)[keep]
+
+    def redetection_rate(self) -> float:
+        # Share of flow steps that needed a new corner detection
+        if self.flow_steps == 0:
+            return 0.0
+        return self.feature_detections / self.flow_steps
+
     def get_optical_flow_vectors(
         self,
     ) -> tuple[tuple[list | None, list | None], np.ndarray | None]:
         good_old = []
         good_new = []
-        prev_frame_gray = cv.cvtColor(self.prev_frame, cv.COLOR_BGR2GRAY)
+        if self.prev_frame_gray is None or not self.reuse_flow_grayscale:
+            self.prev_frame_gray = self.to_gray(self.prev_frame)
+        prev_frame_gray = self.prev_frame_gray
         new_frame = self.get_frame()
         if not self.isActive:
             return ((None, None), None)
 
-        new_frame_gray = cv.cvtColor(new_frame, cv.COLOR_BGR2GRAY)
+        new_frame_gray = self.to_gray(new_frame)
 
         # find features in our old grayscale frame. feature mask is dynamic but manual
-        p0 = cv.goodFeaturesToTrack(
-            prev_frame_gray, mask=self.feature_mask, **self.st_params
-        )
+        p0 = self._get_features_to_track(prev_frame_gray)
+        if p0 is None or len(p0) == 0:
+            self.prev_frame = new_frame
+            self.prev_frame_gray = new_frame_gray
+            self.tracked_points = None
+            return ((None, None), new_frame)
+
         p1, st, err = cv.calcOpticalFlowPyrLK(
             prev_frame_gray, new_frame_gray, p0, None, **self.lk_params
         )
@@ -239,7 +413,121 @@ class OpticalFlow(feed.RpmFromFeed):
             # good_old = p0[(st == 1) & (abs(err) < self.pixel_threshold)]
             good_old = p0[(st == 1)]
 
+        # Nothing came through tracking, corners are detected again on the next frame
+        if self.track_features:
+            self.tracked_points = (
+                None if p1 is None else self._prune_tracked_points(good_new)
+            )
+
         # Set the new frame to be considered "old" for next call
         self.prev_frame = new_frame
+        self.prev_frame_gray = new_frame_gray
 
         return ((good_new, good_old), new_frame)
+
+
+class DenseOpticalFlow(OpticalFlow):
+    """
+    Dense optical flow (Farneback, or DIS in its ultrafast preset) on a downscaled
+    grayscale image. Only an annulus between the deadzone and the crop edge is used, so
+    the hub and the corners of the crop do not count. Useful for low-texture blades
+    where corner detection finds too few features.
+
+    Moving annulus pixels are handed out as point pairs in full resolution coordinates,
+    so they go through the same angular velocity estimator as tracked features and
+    end up as one robust angular velocity per frame.
+
+    Args:
+        **kwargs (dict from JSON-config file): see software/config/config_template.json.
+
+    """
+
+    def __init__(self, **kwargs):
+        # One angular velocity per frame from per-pixel flow needs the angular estimator
+        kwargs["flow_estimator"] = "angular"
+        super().__init__(**kwargs)
+        self.dense_flow_scale = kwargs.get("dense_flow_scale", 0.25)
+        self.dense_flow_algorithm = kwargs.get("dense_flow_algorithm", "farneback")
+        self.dense_min_flow = kwargs.get("dense_min_flow", 0.2)
+
+        if self.dense_flow_algorithm == "dis":
+            self.dis = cv.DISOpticalFlow_create(cv.DISOPTICAL_FLOW_PRESET_ULTRAFAST)
+        elif self.dense_flow_algorithm != "farneback":
+            raise ValueError(
+                f"Unknown dense_flow_algorithm '{self.dense_flow_algorithm}', "
+                "use 'dis' or 'farneback'"
+            )
+
+        self._set_annulus()
+        self.prev_small = self._downscale_gray(self.prev_frame)
+
+    def _set_annulus(self) -> None:
+        h, w = self.feature_mask.shape
+        self.dense_size = (
+            max(1, round(w * self.dense_flow_scale)),
+            max(1, round(h * self.dense_flow_scale)),
+        )
+        self.dense_scale_x = self.dense_size[0] / w
+        self.dense_scale_y = self.dense_size[1] / h
+
+        # Outside the deadzone, inside the ellipse that touches the crop edges
+        yy, xx = np.mgrid[0:h, 0:w]
+        inside = ((xx - (w - 1) / 2) / (w / 2)) ** 2 + (
+            (yy - (h - 1) / 2) / (h / 2)
+        ) ** 2 <= 1
+        annulus = ((self.feature_mask > 0) & inside).astype(np.uint8)
+        annulus = cv.resize(annulus, self.dense_size, interpolation=cv.INTER_NEAREST)
+
+        self.annulus_rows, self.annulus_cols = np.nonzero(annulus)
+        self.annulus_points = np.stack(
+            [self.annulus_cols, self.annulus_rows], axis=1
+        ).astype(np.float32)
+
+    def _downscale_gray(self, frame: np.ndarray) -> np.ndarray:
+        gray = self.to_gray(frame)
+        return cv.resize(gray, self.dense_size, interpolation=cv.INTER_AREA)
+
+    def _dense_flow(self, prev_small: np.ndarray, new_small: np.ndarray) -> np.ndarray:
+        if self.dense_flow_algorithm == "dis":
+            return self.dis.calc(prev_small, new_small, None)
+        return cv.calcOpticalFlowFarneback(
+            prev_small, new_small, None, 0.5, 3, 15, 3, 5, 1.2, 0
+        )
+
+    def get_optical_flow_vectors(
+        self,
+    ) -> tuple[tuple[np.ndarray | None, np.ndarray | None], np.ndarray | None]:
+        new_frame = self.get_frame()
+        if not self.isActive:
+            return ((None, None), None)
+
+        new_small = self._downscale_gray(new_frame)
+        flow = self._dense_flow(self.prev_small, new_small)
+        self.prev_frame = new_frame
+        self.prev_small = new_small
+        self.flow_steps += 1
+
+        # Static pixels (background, blade interiors without texture) carry no information
+        vectors = flow[self.annulus_rows, self.annulus_cols]
+        moving = np.einsum("ij,ij->i", vectors, vectors) >= self.dense_min_flow**2
+        if not np.any(moving):
+            return ((None, None), new_frame)
+
+        old_points = self.annulus_points[moving]
+        new_points = old_points + vectors[moving]
+        # Pixel centres line up between the two resolutions, not pixel corners
+        scale = np.array([self.dense_scale_x, self.dense_scale_y], dtype=np.float32)
+        return (
+            ((new_points + 0.5) / scale - 0.5, (old_points + 0.5) / scale - 0.5),
+            new_frame,
+        )
+
+    def draw_optical_flow(
+        self, image: np.ndarray, old_points: list, new_points: list, overwrite=False
+    ) -> np.ndarray:
+        # Only draw a sample of the flow field
+        step = max(1, len(new_points) // len(self.color))
+        n = len(self.color)
+        return super().draw_optical_flow(
+            image, old_points[::step][:n], new_points[::step][:n], overwrite
+        )
@@ -0,0 +1,258 @@
+import queue
+import threading
+import time
+import cv2 as cv
+
+# Passed down the queues after the last frame
+_END = object()
+
+
+def pipeline_params(params: dict) -> dict:
+    """
+    The config as the pipeline runs it. Gating, adaptive decimation, resolution scaling
+    and late-frame dropping feed detection results back into the earlier stages, and
+    the decode stage replaces the prefetch thread, so those are turned off.
+
+    Args:
+        params (dict from JSON-config file): see software/config/config_template.json.
+
+    """
+    return {
+        **params,
+        "prefetch_depth": 0,
+        "coarse_gate_fraction": 0,
+        "predictive_gating": False,
+        "adaptive_decimation": False,
+        "resolution_scaling": False,
+        "drop_late_frames": False,
+    }
+
+
+class StageMetrics:
+    """
+    Counters of one pipeline stage: how many frames it handled, how long it was busy
+    with them, and how full the queue in front of it was.
+
+    Args:
+        name (str): name of the stage.
+        queue_size (int): capacity of the queue in front of the stage, 0 if there is none.
+
+    """
+
+    def __init__(self, name: str, queue_size: int = 0):
+        self.name = name
+        self.queue_size = queue_size
+        self.frames = 0
+        self.busy_time = 0.0
+        self.queued_total = 0
+
+    def record(self, busy_time: float, queued: int = 0) -> None:
+        self.frames += 1
+        self.busy_time += busy_time
+        self.queued_total += queued
+
+    def summary(self, wall_time: float) -> str:
+        frames = max(self.frames, 1)
+        text = (
+            f"{self.name:<10} {self.frames} frames, "
+            f"{round(self.busy_time / frames * 1000, 3)} ms/frame, "
+            f"busy {round(100 * self.busy_time / max(wall_time, 1e-9), 1)}%"
+        )
+        if self.queue_size:
+            text += f", queue {round(self.queued_total / frames, 2)}/{self.queue_size}"
+        return text
+
+
+class BpmPipeline:
+    """
+    Runs a BpmRunner as stages on their own threads, connected by bounded queues:
+    decode (read from the source), preprocess (crop, luma, contrast and the box
+    morphology), detect (frame buffer, statistics, ticks, RPM) and output (rows and
+    display, on the calling thread since HighGUI wants that). Each stage handles one
+    frame at a time, in order, so the ticks are the same as with the serial loop.
+    OpenCV releases the GIL while decoding and during morphology, so those stages
+    really do overlap with the rest.
+
+    Args:
+        runner (BpmRunner): the runner of a feed created with pipeline_params.
+        queue_size (int): how many frames may wait in front of every stage.
+
+    """
+
+    def __init__(self, runner, queue_size: int = 4):
+        if queue_size < 1:
+            raise ValueError("Pipeline queues need room for at least one frame")
+
+        self.runner = runner
+        self.feed = runner.feed
+        self.queue_size = queue_size
+        self.decoded = queue.Queue(maxsize=queue_size)
+        self.preprocessed = queue.Queue(maxsize=queue_size)
+        self.detected = queue.Queue(maxsize=queue_size)
+        self.metrics = {
+            "decode": StageMetrics("decode"),
+            "preprocess": StageMetrics("preprocess", queue_size),
+            "detect": StageMetrics("detect", queue_size),
+            "output": StageMetrics("output", queue_size),
+        }
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.wall_time = 0.0
+        self.stopped = threading.Event()
+        self.error = None
+
+        # Processed regions only need to outlive the engine's buffers for these
+        self.keep_regions = not runner.deploy or self.feed.store_subregions
+
+    def _put(self, target: queue.Queue, packet) -> None:
+        while not self.stopped.is_set():
+            try:
+                target.put(packet, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _get(self, source: queue.Queue):
+        while not self.stopped.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _END
+
+    def _fail(self, error: BaseException) -> None:
+        if self.error is None:
+            self.error = error
+        self.stopped.set()
+
+    def _decode(self) -> None:
+        video = self.feed.video
+        stage = self.metrics["decode"]
+        try:
+            while not self.stopped.is_set():
+                start = time.perf_counter()
+                ret, frame = video.read()
+                if not ret:
+                    break
+
+                # Frame bus views are overwritten sooner than the queues give them back
+                if not frame.flags.writeable:
+                    frame = frame.copy()
+
+                # Noted now, the feed's counters are only updated in the detect stage
+                packet = {
+                    "frame": frame,
+                    "skipped": getattr(video, "last_skipped", 0),
+                    "position_msec": video.get(cv.CAP_PROP_POS_MSEC),
+                    "arrival": getattr(video, "last_arrival", None) or time.monotonic(),
+                    "decoded_at": time.perf_counter(),
+                }
+                stage.record(time.perf_counter() - start)
+                self._put(self.decoded, packet)
+        except BaseException as error:
+            self._fail(error)
+        finally:
+            self._put(self.decoded, _END)
+
+    def _preprocess(self, packet: dict) -> dict:
+        frame = self.feed.prepare_frame(packet["frame"])
+        engine = self.feed.engine
+        packet["frame"] = frame
+        packet["intensities"] = engine.process(frame)
+        packet["regions"] = (
+            [region.copy() for region in engine.processed_regions]
+            if self.keep_regions
+            else None
+        )
+        return packet
+
+    def _detect(self, packet: dict) -> dict:
+        self.feed.count_frame(
+            packet["skipped"], packet["position_msec"], packet["arrival"]
+        )
+        self.runner.detect(packet["intensities"], packet["regions"])
+        packet["row"] = self.runner.report()
+        return packet
+
+    def _run_stage(self, name: str, work, source: queue.Queue, target: queue.Queue):
+        stage = self.metrics[name]
+        try:
+            while True:
+                packet = self._get(source)
+                if packet is _END:
+                    break
+                queued = source.qsize()
+                start = time.perf_counter()
+                packet = work(packet)
+                stage.record(time.perf_counter() - start, queued)
+                self._put(target, packet)
+        except BaseException as error:
+            self._fail(error)
+        finally:
+            self._put(target, _END)
+
+    def run(self) -> None:
+        """
+        Processes the whole feed. Returns once the last frame is written, or when Esc
+        is pressed in the display window.
+
+        """
+        threads = [
+            threading.Thread(target=self._decode, daemon=True),
+            threading.Thread(
+                target=self._run_stage,
+                args=("preprocess", self._preprocess, self.decoded, self.preprocessed),
+                daemon=True,
+            ),
+            threading.Thread(
+                target=self._run_stage,
+                args=("detect", self._detect, self.preprocessed, self.detected),
+                daemon=True,
+            ),
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+
+        stage = self.metrics["output"]
+        try:
+            while True:
+                packet = self._get(self.detected)
+                if packet is _END:
+                    break
+                queued = self.detected.qsize()
+                output_start = time.perf_counter()
+                if packet["row"] is not None:
+                    self.runner.output_file.write(packet["row"])
+                if not self.runner.deploy:
+                    display_frame = self.runner.draw(
+                        packet["frame"], self.feed.bounds, packet["regions"]
+                    )
+                    cv.imshow("Image feed", display_frame)
+                    if cv.waitKey(1) & 0xFF == 27:
+                        self.stopped.set()
+
+                done = time.perf_counter()
+                stage.record(done - output_start, queued)
+                latency = done - packet["decoded_at"]
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+        finally:
+            self.stopped.set()
+            for thread in threads:
+                thread.join()
+            self.wall_time = time.perf_counter() - start
+
+        self.feed.isActive = False
+        if self.error is not None:
+            raise self.error
+
+    def print_metrics(self) -> None:
+        for stage in self.metrics.values():
+            print(f"Pipeline {stage.summary(self.wall_time)}")
+        frames = max(self.metrics["output"].frames, 1)
+        print(
+            f"Pipeline latency (decode to output): "
+            f"{round(self.latency_total / frames * 1000, 3)} ms mean, "
+            f"{round(self.latency_max * 1000, 3)} ms max"
+        )
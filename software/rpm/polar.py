@@ -0,0 +1,159 @@
+import hashlib
+import math
+import os
+import cv2 as cv
+import numpy as np
+from .feed import feed
+
+
+class PolarPhaseTracker(feed.RpmFromFeed):
+    """
+    Samples an annulus around the hub into a small (radius x angle) strip every frame
+    and tracks how far the blades turned since the previous frame, by circular
+    cross-correlation of the two strips along the angle axis. Gives an RPM estimate on
+    every frame instead of once per blade pass.
+
+    The annulus follows the crop's aspect ratio, so a turbine seen at an angle (an
+    ellipse in a RECT crop) is sampled along its blades. The cv.remap tables are built
+    once and cached on disk, keyed by the crop geometry.
+
+    Args:
+        **kwargs (dict from JSON-config file): see software/config/config_template.json.
+
+    """
+
+    def __init__(self, **kwargs):
+        # Only the strip is converted to luma, so there is no point in a luma feed
+        kwargs["grayscale"] = False
+        self.contrast_multiplier = kwargs["contrast_multiplier"]
+        self.adjust_contrast = self.contrast_multiplier != 1
+        super().__init__(**kwargs)
+        self.draw = feed.Draw(self)
+        self.real_rpm = kwargs["real_rpm"]
+        self.deadzone_offset_x = kwargs.get("deadzone_offset_x", 0)
+        self.deadzone_offset_y = kwargs.get("deadzone_offset_y", 0)
+        self.radius_range = kwargs.get("polar_radius_range", [0.3, 0.9])
+        self.angle_bins = kwargs.get("polar_angle_bins", 360)
+        self.radius_bins = kwargs.get("polar_radius_bins", 16)
+        self.min_correlation = kwargs.get("polar_min_correlation", 0.0)
+        self.cache_dir = kwargs.get("polar_cache_dir", "runs/cache")
+        self.max_rpm = kwargs.get("polar_max_rpm", 30)
+
+        self.map1, self.map2 = self._load_or_build_maps()
+
+        # Blades can't turn further than this between two frames. Beyond a sixth of a
+        # turn the three blades are indistinguishable anyway.
+        max_shift = self.max_rpm / 60 / self.fps * self.angle_bins
+        self.max_lag = min(math.ceil(max_shift) + 1, self.angle_bins // 6)
+
+        self.prev_spectrum = None
+        self.prev_energy = 0.0
+        self.phase = 0.0  # Accumulated blade angle in radians
+        self.correlation = 0.0
+
+    def get_hub_center(self) -> tuple[float, float]:
+        cx, cy = self.get_center_pixel()
+        return (cx + self.deadzone_offset_x, cy + self.deadzone_offset_y)
+
+    def _geometry_key(self) -> str:
+        geometry = (
+            self.h,
+            self.w,
+            self.get_hub_center(),
+            tuple(self.radius_range),
+            self.radius_bins,
+            self.angle_bins,
+        )
+        return hashlib.sha1(repr(geometry).encode()).hexdigest()[:16]
+
+    def _build_maps(self) -> tuple[np.ndarray, np.ndarray]:
+        cx, cy = self.get_hub_center()
+        fractions = np.linspace(*self.radius_range, self.radius_bins)[:, np.newaxis]
+        angles = np.arange(self.angle_bins) * (2 * np.pi / self.angle_bins)
+
+        # Rows are radii, columns are angles. y grows downwards in image coordinates
+        map_x = (cx + fractions * self.radius_x * np.cos(angles)).astype(np.float32)
+        map_y = (cy - fractions * self.radius_y * np.sin(angles)).astype(np.float32)
+
+        # Fixed point maps are faster to remap with
+        return cv.convertMaps(map_x, map_y, cv.CV_16SC2)
+
+    def _load_or_build_maps(self) -> tuple[np.ndarray, np.ndarray]:
+        path = os.path.join(self.cache_dir, f"polar_{self._geometry_key()}.npz")
+        try:
+            with np.load(path) as cached:
+                return (cached["map1"], cached["map2"])
+        except (OSError, KeyError, ValueError):
+            pass
+
+        map1, map2 = self._build_maps()
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            np.savez(path, map1=map1, map2=map2)
+        except OSError:
+            # A read-only location only costs us the rebuild next time
+            pass
+        return (map1, map2)
+
+    def sample_strip(self, frame: np.ndarray) -> np.ndarray:
+        strip = cv.remap(frame, self.map1, self.map2, cv.INTER_LINEAR)
+        if strip.ndim == 3:
+            strip = cv.cvtColor(strip, cv.COLOR_BGR2GRAY)
+        return strip
+
+    def estimate_rpm(self, frame: np.ndarray) -> float | None:
+        strip = self.sample_strip(frame).astype(np.float32)
+        strip -= strip.mean(axis=1, keepdims=True)
+        spectrum = np.fft.rfft(strip, axis=1)
+        energy = float(np.sum(strip * strip))
+
+        prev_spectrum, prev_energy = self.prev_spectrum, self.prev_energy
+        self.prev_spectrum, self.prev_energy = spectrum, energy
+        if prev_spectrum is None or energy == 0 or prev_energy == 0:
+            return None
+
+        # Circular cross-correlation of every radius row, summed over the rows.
+        # Entry k is how well the current strip matches the previous one rotated by k bins
+        cross = np.fft.irfft(
+            np.sum(spectrum * np.conj(prev_spectrum), axis=0), n=self.angle_bins
+        )
+        lags = np.arange(-self.max_lag, self.max_lag + 1)
+        window = cross[lags % self.angle_bins]
+        peak = int(np.argmax(window))
+        self.correlation = float(window[peak]) / math.sqrt(energy * prev_energy)
+        if self.correlation < self.min_correlation:
+            return None
+
+        # Parabola through the peak for a sub-bin shift
+        offset = 0.0
+        if 0 < peak < len(window) - 1:
+            left, centre, right = window[peak - 1 : peak + 2]
+            curvature = left - 2 * centre + right
+            if curvature < 0:
+                offset = 0.5 * (left - right) / curvature
+
+        shift = (lags[peak] + offset) * (2 * np.pi / self.angle_bins)
+        self.phase += shift
+
+        # Units: (rad / frame) * (frames / second) = rad/s. Direction is ignored
+        return 60 * abs(shift) * self.fps / (2 * np.pi)
+
+    def draw_annulus(self, frame: np.ndarray) -> np.ndarray:
+        image = self.draw.colour_view(frame).copy()
+        center = tuple(round(c) for c in self.get_hub_center())
+        for fraction in self.radius_range:
+            axes = (round(fraction * self.radius_x), round(fraction * self.radius_y))
+            cv.ellipse(image, center, axes, 0, 0, 360, (0, 255, 0), 1)
+
+        # The accumulated blade angle, so you can see it follow a blade
+        # (up to the three-fold symmetry)
+        tip = (
+            round(
+                center[0] + self.radius_range[1] * self.radius_x * math.cos(self.phase)
+            ),
+            round(
+                center[1] - self.radius_range[1] * self.radius_y * math.sin(self.phase)
+            ),
+        )
+        cv.line(image, center, tip, (0, 0, 255), 1)
+        return image
@@ -0,0 +1,88 @@
+import signal
+import sys
+import time
+from .feed import capture, feed
+from .feed.frame_bus import FrameBusWriter
+
+
+class FramePublisher(feed.Feed):
+    """
+    Capture process of a frame bus. Reads the configured source like any other feed
+    (crop, grayscale, timestamps) and publishes every frame into shared memory, where
+    estimator processes with 'bus:<frame_bus>' as their target read it without copying.
+    Publishing never waits for the estimators. Estimators that fall behind skip frames,
+    and are reported here.
+
+    Args:
+        **kwargs (dict from JSON-config file): see software/config/config_template.json.
+
+    """
+
+    def __init__(self, **kwargs):
+        # Contrast is up to every estimator
+        self.adjust_contrast = False
+        super().__init__(**kwargs)
+        self.bus_name = kwargs["frame_bus"]
+        self.slots = kwargs.get("frame_bus_slots", 32)
+        self.max_consumers = kwargs.get("frame_bus_max_consumers", 8)
+
+        # Saved videos are played back at their fps, the way a camera delivers them
+        self.pace = kwargs.get("frame_bus_pace", not capture.is_camera(self.target))
+        self.bus = None
+        self.slow = set()
+        self.slow_reports = 0
+
+    def report_slow_consumers(self) -> None:
+        slow = {}
+        for pid, behind in self.bus.slow_consumers():
+            slow[pid] = behind
+            if pid not in self.slow:
+                self.slow_reports += 1
+                print(
+                    f"Frame bus: consumer {pid} is {behind} frames behind "
+                    f"and skips frames to catch up"
+                )
+        self.slow = set(slow)
+
+    def run(self) -> None:
+        # Stopping the service (SIGTERM) unwinds like Ctrl+C, so the bus is released
+        previous_handler = signal.signal(
+            signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum)
+        )
+        start = time.monotonic()
+        try:
+            while True:
+                frame = self.get_frame()
+                if not self.isActive:
+                    break
+
+                # The shape is only known once there is a frame
+                if self.bus is None:
+                    self.bus = FrameBusWriter(
+                        self.bus_name, frame.shape, self.slots, self.max_consumers
+                    )
+                    print(
+                        f"Frame bus '{self.bus_name}': publishing {frame.shape} frames"
+                    )
+
+                arrival = self.frame_arrival
+                if self.pace:
+                    delay = start + self.frames_read / self.fps - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    arrival = time.monotonic()
+                self.bus.publish(
+                    frame, self.frame_timestamp, arrival, self.timestamps_monotonic()
+                )
+
+                if self.frames_read % max(int(self.fps), 1) == 0:
+                    self.report_slow_consumers()
+        finally:
+            # Also on Ctrl+C and SIGTERM, so the shared memory doesn't outlive us
+            signal.signal(signal.SIGTERM, previous_handler)
+            if self.bus is not None:
+                print(
+                    f"Frame bus '{self.bus_name}': published {self.frames_read} "
+                    f"frames, {self.slow_reports} slow consumer reports"
+                )
+                self.bus.release()
@@ -0,0 +1,109 @@
+import numpy as np
+from . import calculate_rpm as crpm
+
+
+class SpectralRpmEstimator:
+    """
+    Estimates RPM from the frequency content of the per-box intensity series instead of
+    from individual detections. Blades sweeping over the boxes make the intensities
+    oscillate at the blade-pass frequency (3x the rotor frequency), which shows up as
+    a peak in the power spectrum.
+
+    Every frame only costs a row write into a ring buffer. The spectrum is computed when
+    estimate() is called: Welch averaging over half-overlapping Hann segments, with the
+    power of all boxes summed so their phase offsets don't matter. The peak is searched
+    within the blade-pass band of [min_rpm, max_rpm] and refined to sub-bin precision.
+
+    Args:
+        window (int): length of the analysis window in frames.
+        width (int): number of boxes.
+        fps (float): FPS of the video feed.
+        min_rpm (float): lowest RPM to search for.
+        max_rpm (float): highest RPM to search for.
+        segments (int): number of Welch segments the window is split into.
+        pad_factor (int): zero padding of each segment, finer bins for the peak search.
+
+    """
+
+    def __init__(
+        self,
+        window: int,
+        width: int,
+        fps: float,
+        min_rpm: float = 1.0,
+        max_rpm: float = 30.0,
+        segments: int = 1,
+        pad_factor: int = 4,
+    ):
+        if segments < 1:
+            raise ValueError("The spectral estimator needs at least one segment")
+
+        self.window = window
+        self.fps = fps
+        self.count = 0
+        self.samples = np.zeros((window, width))
+
+        # Welch segments overlap by half, so K segments cover (K + 1) half-segments
+        self.segments = segments
+        self.segment_length = 2 * window // (segments + 1)
+        self.step = self.segment_length // 2
+        self.taper = np.hanning(self.segment_length)[:, np.newaxis]
+        self.nfft = pad_factor * (1 << (self.segment_length - 1).bit_length())
+
+        # Only look for peaks where blade passes can actually be
+        freqs = np.fft.rfftfreq(self.nfft, 1 / fps)
+        min_freq = 3 * min_rpm / 60
+        max_freq = 3 * max_rpm / 60
+        self.band = slice(
+            max(int(np.searchsorted(freqs, min_freq)), 1),
+            int(np.searchsorted(freqs, max_freq, side="right")),
+        )
+        self.power = np.zeros(freqs.size)
+        self.peak_frequency = None
+
+    def insert(self, intensities: np.ndarray) -> None:
+        self.samples[self.count % self.window] = intensities
+        self.count += 1
+
+    def reset(self) -> None:
+        # Forget the samples, the window fills up again
+        self.count = 0
+        self.samples[:] = 0
+
+    def is_ready(self) -> bool:
+        return self.count >= self.window
+
+    def _ordered_samples(self) -> np.ndarray:
+        start = self.count % self.window
+        return np.concatenate((self.samples[start:], self.samples[:start]))
+
+    def power_spectrum(self) -> np.ndarray:
+        samples = self._ordered_samples()
+        self.power[:] = 0
+        for i in range(self.segments):
+            segment = samples[i * self.step : i * self.step + self.segment_length]
+            segment = (segment - segment.mean(axis=0)) * self.taper
+            spectrum = np.fft.rfft(segment, n=self.nfft, axis=0)
+            self.power += np.sum(spectrum.real**2 + spectrum.imag**2, axis=1)
+        return self.power
+
+    def estimate(self) -> float | None:
+        if not self.is_ready() or self.band.start >= self.band.stop:
+            return None
+
+        power = self.power_spectrum()
+        peak = self.band.start + int(np.argmax(power[self.band]))
+        if power[peak] <= 0:
+            return None
+
+        # Fit a parabola through the log power around the peak (exact for a Gaussian peak,
+        # which is close to what a Hann window gives)
+        offset = 0.0
+        if 0 < peak < power.size - 1 and power[peak - 1] > 0 and power[peak + 1] > 0:
+            left, centre, right = np.log(power[peak - 1 : peak + 2])
+            curvature = left - 2 * centre + right
+            if curvature < 0:
+                offset = 0.5 * (left - right) / curvature
+
+        self.peak_frequency = (peak + offset) * self.fps / self.nfft
+        return crpm.rpm_from_blade_pass_frequency(self.peak_frequency)
@@ -0,0 +1,242 @@
+import bisect
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import cv2 as cv
+from . import bpm_cascade
+from .bpm_runner import BpmRunner
+
+
+def keyframe_index(path: str) -> tuple[int, list[int]]:
+    """
+    Frame count and keyframes of a video file. Built by reading the packets of the
+    file without decoding them, and saved next to it (<video>.keyframes.json), so it's
+    only built once per file.
+
+    Args:
+        path (str): the video file.
+
+    Returns:
+        tuple[int, list[int]]: number of frames and the keyframe numbers, in order.
+        The keyframes are empty if the backend can't read raw packets.
+
+    """
+    stat = os.stat(path)
+    cache_path = f"{path}.keyframes.json"
+    try:
+        with open(cache_path) as cache_file:
+            cache = json.load(cache_file)
+        if cache["size"] == stat.st_size and cache["mtime"] == stat.st_mtime:
+            return (cache["frames"], cache["keyframes"])
+    except (OSError, ValueError, KeyError):
+        pass
+
+    video = cv.VideoCapture(path, cv.CAP_FFMPEG, [cv.CAP_PROP_FORMAT, -1])
+    frames = 0
+    keyframes = []
+    while video.grab():
+        if video.get(cv.CAP_PROP_LRF_HAS_KEY_FRAME):
+            keyframes.append(frames)
+        frames += 1
+    video.release()
+
+    # Without raw packets, fall back on the container's frame count
+    if frames == 0:
+        video = cv.VideoCapture(path)
+        frames = int(video.get(cv.CAP_PROP_FRAME_COUNT))
+        video.release()
+        return (frames, [])
+
+    cache = {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "frames": frames,
+        "keyframes": keyframes,
+    }
+    try:
+        with open(cache_path, "w") as cache_file:
+            json.dump(cache, cache_file)
+    except OSError:
+        # Read-only storage, it's built again next time
+        pass
+    return (frames, keyframes)
+
+
+def plan_shards(
+    frames: int, shards: int, warmup_frames: int, keyframes: list[int]
+) -> list[dict]:
+    """
+    Splits a video into equal time shards. Every shard starts decoding warmup_frames
+    before its first frame, moved back to the keyframe before that, so the seek lands
+    on a keyframe and nothing is decoded only to be thrown away.
+
+    Args:
+        frames (int): number of frames in the video.
+        shards (int): number of shards.
+        warmup_frames (int): frames processed before a shard's first frame.
+        keyframes (list[int]): keyframes of the video, see keyframe_index.
+
+    Returns:
+        list[dict]: index, start, end (exclusive) and warmup_start of every shard.
+
+    """
+    plan = []
+    for i in range(shards):
+        start = frames * i // shards
+        end = frames * (i + 1) // shards
+        warmup_start = max(start - warmup_frames, 0)
+        k = bisect.bisect_right(keyframes, warmup_start) - 1
+        if k >= 0:
+            warmup_start = keyframes[k]
+        plan.append(
+            {"index": i, "start": start, "end": end, "warmup_start": warmup_start}
+        )
+    return plan
+
+
+def shard_params(params: dict) -> dict:
+    # Shards seek their own capture, so no prefetching from frame 0 or ffmpeg pipes.
+    # They're offline, nothing is late, and a rescale depends on how busy the machine
+    # is, so the shards would no longer give the ticks of one run over the video.
+    # Neither would decimation: a shard's frames_read starts at its warm-up frame, not
+    # in the phase of a decimated run, and the warm-up is counted in capture frames
+    return {
+        **params,
+        "prefetch_depth": 0,
+        "capture_crop": False,
+        "drop_late_frames": False,
+        "pipeline": False,
+        "resolution_scaling": False,
+        "adaptive_decimation": False,
+    }
+
+
+class ShardRows:
+    """
+    Output file of a shard: keeps every row with the frame it was written at, so the
+    rows of the warm-up can be left out.
+
+    Args:
+        feed (BpmCascade): the shard's feed.
+
+    """
+
+    def __init__(self, feed):
+        self.feed = feed
+        self.rows = []
+
+    def write(self, row: str) -> None:
+        self.rows.append((self.feed.frame_cnt, row))
+
+
+def process_shard(params: dict, shard: dict) -> dict:
+    """
+    Runs bpm detection from a shard's warm-up start to its end. The warm-up fills the
+    detection statistics (fb_average_long_buffer) and the RPM buffer, so by the
+    shard's first frame the detector is where a run from the start of the video would
+    be. Frame numbers are counted from the start of the video.
+
+    Args:
+        params (dict from JSON-config file): see software/config/config_template.json.
+        shard (dict): see plan_shards.
+
+    Returns:
+        dict: the shard, with the rows written and the ticks found in it.
+
+    """
+    start_time = time.perf_counter()
+    feed = bpm_cascade.BpmCascade(**shard_params(params))
+    feed.video.set(cv.CAP_PROP_POS_FRAMES, shard["warmup_start"])
+    feed.frame_cnt = feed.frames_read = shard["warmup_start"]
+
+    output = ShardRows(feed)
+    runner = BpmRunner(feed, params, deploy=True, output_file=output)
+
+    # Sub-frame ticks are placed once the peak has passed, which can be after the
+    # shard's last frame
+    end = shard["end"] + (int(params["fps"]) if feed.subframe_ticks else 0)
+    ticks = []
+    frame = feed.get_frame()
+    while feed.isActive and feed.frame_cnt <= end:
+        runner.process(frame)
+        if runner.frame_ticks and (not ticks or runner.frame_ticks[-1] != ticks[-1]):
+            ticks.append(runner.frame_ticks[-1])
+        frame = feed.get_frame()
+    frames = feed.frame_cnt - shard["warmup_start"]
+    feed.release()
+
+    # Rows go by the frame they were written at, ticks by the frame they were placed
+    # at. The shards don't overlap, so neither is duplicated or missed at a boundary
+    # (frame_cnt counts from 1, so a shard's frames are start + 1 to end)
+    first, last = shard["start"] + 1, shard["end"]
+    return {
+        **shard,
+        "rows": [row for frame_cnt, row in output.rows if first <= frame_cnt <= last],
+        "ticks": [tick for tick in ticks if first <= tick <= last],
+        "frames": frames,
+        "seconds": time.perf_counter() - start_time,
+    }
+
+
+def run(params: dict, deploy: bool = False, output_path: str = "runs/out.csv"):
+    """
+    Runs bpm detection over one long video in time_shards parallel processes, and
+    merges their rows into one output file, in order.
+
+    Args:
+        params (dict from JSON-config file): see software/config/config_template.json.
+        deploy (bool): write the rows to output_path, otherwise only print the stats.
+        output_path (str): where the merged rows go.
+
+    """
+    target = params["target"]
+    if params["mode"] != "bpm" or not os.path.isfile(str(target)):
+        raise ValueError("time_shards needs bpm mode and a video file as target")
+
+    index_start = time.perf_counter()
+    frames, keyframes = keyframe_index(target)
+    print(
+        f"Keyframe index: {frames} frames, {len(keyframes)} keyframes "
+        f"({round(time.perf_counter() - index_start, 3)} s)"
+    )
+
+    # fb_average_long_buffer takes fps*60 samples, one every
+    # color_delta_update_frequency frames. The warm-up has to fill it
+    warmup_frames = int(params["fps"] * 60) * params.get(
+        "color_delta_update_frequency", 1
+    )
+    shards = plan_shards(frames, params["time_shards"], warmup_frames, keyframes)
+    workers = min(len(shards), os.cpu_count() or 1)
+    start_time = datetime.now()
+    wall_start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(process_shard, [params] * len(shards), shards))
+    elapsed = time.perf_counter() - wall_start
+
+    ticks = []
+    for result in results:
+        print(
+            f"Shard {result['index']}: frames {result['start']}-{result['end']} "
+            f"(warm-up from {result['warmup_start']}), {len(result['ticks'])} ticks, "
+            f"{len(result['rows'])} rows, {round(result['seconds'], 3)} s"
+        )
+        ticks += result["ticks"]
+    decoded = sum(result["frames"] for result in results)
+    print(
+        f"{len(ticks)} ticks over {frames} frames in {round(elapsed, 3)} s "
+        f"({round(frames / max(elapsed, 1e-9), 1)} frames/s), "
+        f"{decoded - frames} frames of warm-up"
+    )
+
+    if deploy:
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        with open(output_path, "w") as output_file:
+            output_file.write(
+                f"Logging started at {start_time.strftime('%d/%m/%Y %H:%M:%S')}\n"
+            )
+            for result in results:
+                output_file.writelines(result["rows"])
+            end_time = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+            output_file.write(f"Logging ended at {end_time}\n")
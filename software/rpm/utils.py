@@ -63,9 +63,11 @@ def dynamic_log_string(
     rpm_monitor,
     tick_timestamp,
     colorvals,
-    rpm_buffer: deque | list,
+    rpm_buffer: "RollingStatistics | deque | list",
     print_error=False,
     real_rpm=0,
+    spectral_rpm=None,
+    latency_ms=None,
 ):
     frame_tick_printstr = (
         str(rpm_monitor.frame_cnt) if rpm_monitor.log_frame_ticks else None
@@ -85,7 +87,11 @@ def dynamic_log_string(
     )
 
     # This one is not negotiable and the thought of making this removable is silly
-    rpm_printstr = str(np.mean(rpm_buffer))
+    rpm_printstr = str(
+        rpm_buffer.mean
+        if isinstance(rpm_buffer, RollingStatistics)
+        else np.mean(rpm_buffer)
+    )
 
     print_items = [
         frame_tick_printstr,
@@ -105,6 +111,14 @@ def dynamic_log_string(
         error = calculate_error_percentage(float(rpm_printstr), real_rpm)
         total_out_string += "," + str(error)
 
+    # Logged last so existing columns keep their positions
+    if spectral_rpm is not None:
+        total_out_string += "," + str(spectral_rpm)
+
+    # Time from frame capture to this row
+    if latency_ms is not None:
+        total_out_string += "," + str(latency_ms)
+
     total_out_string += "\n"
 
     return total_out_string
@@ -123,12 +137,11 @@ class bcolors:
 
 
 def write_output(
-    turbine_id: int, frame_number: int, rpm: list[float], real_rpm: int | None = None
+    output_file, frame_number: int, rpm: list[float], real_rpm: int | None = None
 ):
-    with open(f"runs/run_turbine{str(turbine_id)}.csv", "a") as output_file:
-        output_file.write(
-            f"{frame_number}, {rpm}, {calculate_error_percentage(float(np.average(rpm)), real_rpm)}\n"
-        )
+    output_file.write(
+        f"{frame_number}, {rpm}, {calculate_error_percentage(float(np.average(rpm)), real_rpm)}\n"
+    )
 
 
 def find_top_n_modes(
@@ -147,3 +160,120 @@ def find_top_n_modes(
         return list(zip(top_values, top_counts))
     else:
         return list(top_values)
+
+
+class RollingStatistics:
+    """
+    Sliding-window statistics that update in O(1) per sample, whatever the window length.
+    Tracks the windowed mean and variance (Welford-style add/remove updates), and
+    optionally the mode through a histogram keyed by rounded value.
+
+    Mode ties are broken towards the smallest value. The floating point sums are
+    recomputed from the window once per window length, so they do not drift on long runs.
+
+    Args:
+        maxlen (int): window length in samples.
+        track_mode (bool): keep the histogram needed for mode().
+        mode_round_delta_to_digit (int): values are rounded to this many digits before counting.
+
+    """
+
+    def __init__(
+        self, maxlen: int, track_mode: bool = True, mode_round_delta_to_digit: int = 1
+    ):
+        self.values = deque(maxlen=maxlen)
+        self.track_mode = track_mode
+        self.scale = 10**mode_round_delta_to_digit
+        self.mean = 0.0
+        self._m2 = 0.0
+        self._updates_since_resync = 0
+
+        # Histogram: rounded key -> count, and count -> keys with that count
+        self._counts: dict[int, int] = {}
+        self._keys_by_count: dict[int, set] = {}
+        self._max_count = 0
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    @property
+    def maxlen(self) -> int:
+        return self.values.maxlen
+
+    @property
+    def full(self) -> bool:
+        return len(self.values) == self.values.maxlen
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def append(self, value: float) -> None:
+        if len(self.values) == self.values.maxlen:
+            self._remove(self.values[0])
+        self.values.append(value)
+        self._add(value)
+
+        self._updates_since_resync += 1
+        if self._updates_since_resync >= self.values.maxlen:
+            self._resync()
+
+    def _add(self, value: float) -> None:
+        n = len(self.values)
+        delta = value - self.mean
+        self.mean += delta / n
+        self._m2 += delta * (value - self.mean)
+
+        if self.track_mode:
+            key = self._key(value)
+            count = self._counts.get(key, 0)
+            if count:
+                self._keys_by_count[count].discard(key)
+            self._counts[key] = count + 1
+            self._keys_by_count.setdefault(count + 1, set()).add(key)
+            self._max_count = max(self._max_count, count + 1)
+
+    def _remove(self, value: float) -> None:
+        n = len(self.values) - 1
+        if n == 0:
+            self.mean, self._m2 = 0.0, 0.0
+        else:
+            delta = value - self.mean
+            self.mean -= delta / n
+            self._m2 -= delta * (value - self.mean)
+
+        if self.track_mode:
+            key = self._key(value)
+            count = self._counts[key]
+            self._keys_by_count[count].discard(key)
+            if count == 1:
+                del self._counts[key]
+            else:
+                self._counts[key] = count - 1
+                self._keys_by_count[count - 1].add(key)
+            if not self._keys_by_count[self._max_count]:
+                self._max_count -= 1
+
+    def _resync(self) -> None:
+        arr = np.asarray(self.values, dtype=float)
+        self.mean = float(np.mean(arr))
+        self._m2 = float(np.sum((arr - self.mean) ** 2))
+        self._updates_since_resync = 0
+
+    def _key(self, value: float) -> int:
+        # Same rounding as np.round(value, digits)
+        return int(np.rint(value * self.scale))
+
+    def variance(self) -> float:
+        if not self.values:
+            return 0.0
+        return max(self._m2, 0.0) / len(self.values)
+
+    def std(self) -> float:
+        return self.variance() ** 0.5
+
+    def mode(self) -> float:
+        if not self.track_mode:
+            raise ValueError("mode() needs track_mode=True")
+        if self._max_count == 0:
+            return 0.0
+        return min(self._keys_by_count[self._max_count]) / self.scale